@@ -0,0 +1,138 @@
+"""
+Statewide, pre-rasterized soil and water layers.
+
+Run this module once after importing new source data:
+
+    python base_rasters.py [--bounds minx miny maxx maxy] [--block-size 4096]
+
+It burns every soil attribute used by /process (taxorder already mapped through
+constants.json) and the water mask onto one aligned 15 m grid, block by block,
+into tiled and compressed GeoTIFFs. Level builds then only read a window of them.
+"""
+import argparse
+import json
+import math
+import os
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, Resampling, transform_bounds
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import box
+from load_data import DataService, SOILDB_PATH, WATERDB_PATH, DEM_PATH, MAIN_CRS
+from raster import rasterize_layers
+from result_cache import CONSTANTS_PATH, hash_key, source_versions
+from water_mask import rasterize_water
+from util import atomic_write, get_elapsed_time
+
+BASE_RASTER_DIR = '../data/base_rasters'
+SOIL_RASTER_PATH = os.path.join(BASE_RASTER_DIR, 'soil.tif')
+WATER_RASTER_PATH = os.path.join(BASE_RASTER_DIR, 'water.tif')
+RESOLUTION = 15 / 111000
+BLOCK_SIZE = 4096
+SOIL_LAYERS = ['map_r', 'silttotal_r', 'claytotal_r', 'sandtotal_r', 'om_r', 'fragvol_r', 'airtempa_r', 'taxorder']
+# Only these inputs feed the base rasters; the DEM and weather table are read per level
+BASE_SOURCE_PATHS = [SOILDB_PATH, WATERDB_PATH, CONSTANTS_PATH]
+GTIFF_OPTIONS = {'driver': 'GTiff', 'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+                 'compress': 'deflate', 'BIGTIFF': 'IF_SAFER'}
+
+
+def base_source_hash():
+    return hash_key(source_versions(BASE_SOURCE_PATHS))
+
+def base_rasters_available():
+    """True when both base rasters exist and were built from the current source files."""
+    for path in [SOIL_RASTER_PATH, WATER_RASTER_PATH]:
+        if not os.path.exists(path):
+            return False
+        with rasterio.open(path) as src:
+            if src.tags().get('source_hash') != base_source_hash():
+                return False
+    return True
+
+def dem_bounds():
+    with rasterio.open(DEM_PATH) as src:
+        return transform_bounds(src.crs, MAIN_CRS, *src.bounds)
+
+def build_base_rasters(data_service, constants, bounds=None, block_size=BLOCK_SIZE):
+    if not data_service.data_loaded:
+        data_service.load_base_data()
+    minx, miny, maxx, maxy = bounds or dem_bounds()
+    width = math.ceil((maxx - minx) / RESOLUTION)
+    height = math.ceil((maxy - miny) / RESOLUTION)
+    transform = from_origin(minx, maxy, RESOLUTION, RESOLUTION)
+    profile = dict(GTIFF_OPTIONS, width=width, height=height, crs=MAIN_CRS, transform=transform)
+    os.makedirs(BASE_RASTER_DIR, exist_ok=True)
+    print("Building {}x{} base rasters in {} px blocks".format(width, height, block_size))
+
+    # Both rasters are written to temporary files and renamed into place only once complete
+    with atomic_write(SOIL_RASTER_PATH, None) as soil_temp, atomic_write(WATER_RASTER_PATH, None) as water_temp:
+        with rasterio.open(soil_temp, 'w', count=len(SOIL_LAYERS), dtype='float32', nodata=np.nan,
+                           predictor=3, **profile) as soil_dst, \
+             rasterio.open(water_temp, 'w', count=1, dtype='uint8', nodata=None, **profile) as water_dst:
+            soil_dst.descriptions = tuple(SOIL_LAYERS)
+            for row in range(0, height, block_size):
+                for col in range(0, width, block_size):
+                    window = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                    block_transform = rasterio.windows.transform(window, transform)
+                    block_shape = (int(window.height), int(window.width))
+                    block_bounds = rasterio.windows.bounds(window, transform)
+                    bounding_box = gpd.GeoDataFrame({'geometry': [box(*block_bounds)]}, crs=MAIN_CRS)
+
+                    soils_gdf = data_service.load_soil_data(bounding_box)
+                    soil_block, _ = rasterize_layers(soils_gdf, SOIL_LAYERS, RESOLUTION,
+                                                     {'taxorder': constants['soil_type_mapping']},
+                                                     block_transform, block_shape)
+                    soil_dst.write(soil_block, window=window)
+
+                    water_block = rasterize_water(data_service.load_flowlines(bounding_box),
+                                                  data_service.load_waterbodies(bounding_box),
+                                                  block_transform, block_shape)
+                    water_dst.write(water_block, 1, window=window)
+                    print("Base raster block {},{} done {}".format(row, col, get_elapsed_time()))
+            for dst in (soil_dst, water_dst):
+                dst.update_tags(source_hash=base_source_hash())
+
+def read_base_window(path, dst_transform, dst_shape, dtype, fill, out=None):
+    """
+    Read the window of a base raster covering the level grid and resample it
+    (nearest) onto that grid. Returns a (bands, height, width) array.
+    """
+    with rasterio.open(path) as src:
+        height, width = dst_shape
+        dst_bounds = rasterio.transform.array_bounds(height, width, dst_transform)
+        window = from_bounds(dst_bounds[0], dst_bounds[1], dst_bounds[2], dst_bounds[3], transform=src.transform)
+        # Pad by a pixel so the level grid, which need not be aligned, is fully covered
+        window = Window(math.floor(window.col_off) - 1, math.floor(window.row_off) - 1,
+                        math.ceil(window.width) + 2, math.ceil(window.height) + 2)
+        data = src.read(window=window, boundless=True, fill_value=fill)
+        if out is None:
+            out = np.empty((src.count, height, width), dtype=dtype)
+        out.fill(fill)
+        reproject(
+            source=data,
+            destination=out,
+            src_transform=src.window_transform(window),
+            src_crs=src.crs,
+            dst_transform=dst_transform,
+            dst_crs=src.crs,
+            resampling=Resampling.nearest)
+    return out
+
+def read_soil_window(dst_transform, dst_shape, out=None):
+    return read_base_window(SOIL_RASTER_PATH, dst_transform, dst_shape, np.float32, np.nan, out)
+
+def read_water_window(dst_transform, dst_shape):
+    return read_base_window(WATER_RASTER_PATH, dst_transform, dst_shape, np.uint8, 0)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute statewide soil and water base rasters.')
+    parser.add_argument('--bounds', nargs=4, type=float, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help='Extent in EPSG:4326 (defaults to the DEM extent)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+    with open(CONSTANTS_PATH) as f:
+        constants = json.load(f)['constants']
+    build_base_rasters(DataService(), constants, args.bounds, args.block_size)
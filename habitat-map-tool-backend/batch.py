@@ -0,0 +1,153 @@
+"""
+Build many levels in one run.
+
+    python batch.py levels.json [--workers N] [--report path]
+
+levels.json holds a list of {name, centerPoint, boundHeight} entries, or an object
+with that list under "levels". Base data is loaded once before the worker pool
+forks, spatially close requests are built together in one worker, and a summary
+report is written next to the levels.
+"""
+import argparse
+import json
+import os
+import time
+import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shapely.geometry import box
+from base_rasters import base_rasters_available
+from raster import normalize_output_formats
+from level_builder import (build_level, create_level, data_service, level_bounds, prefetch_dem, prefetch_vectors,
+                           write_metadata,
+                           LEVELS_DIR, MAIN_CRS)
+
+BATCH_WORKERS = int(os.environ.get('HABITAT_BATCH_WORKERS', os.cpu_count() or 1))
+REPORT_PATH = os.path.join(LEVELS_DIR, 'batch_report.json')
+# Levels whose boxes are within GROUP_DISTANCE degrees of each other share their vector
+# queries and DEM read, as long as the group stays within MAX_GROUP_SPAN degrees and
+# MAX_GROUP_SIZE levels
+GROUP_DISTANCE = 0.05
+MAX_GROUP_SPAN = 0.5
+MAX_GROUP_SIZE = 8
+REQUIRED_FIELDS = ['name', 'centerPoint', 'boundHeight']
+
+
+def validate_entries(entries):
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("A batch needs a non-empty list of levels")
+    for index, entry in enumerate(entries):
+        missing = [field for field in REQUIRED_FIELDS if field not in entry]
+        if missing:
+            raise ValueError("Level {} is missing {}".format(index, ', '.join(missing)))
+        if 'outputFormats' in entry:
+            normalize_output_formats(entry['outputFormats'])
+    names = [entry['name'] for entry in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("Level names in a batch must be unique")
+
+def group_requests(entries, distance=GROUP_DISTANCE, max_span=MAX_GROUP_SPAN, max_size=MAX_GROUP_SIZE):
+    """Greedily cluster entries into groups of nearby boxes. Returns [{'bounds', 'entries'}]."""
+    groups = []
+    for entry in sorted(entries, key=level_bounds):
+        bounds = level_bounds(entry)
+        for group in groups:
+            group_bounds = group['bounds']
+            union = [min(group_bounds[0], bounds[0]), min(group_bounds[1], bounds[1]),
+                     max(group_bounds[2], bounds[2]), max(group_bounds[3], bounds[3])]
+            near = (bounds[0] <= group_bounds[2] + distance and bounds[2] >= group_bounds[0] - distance and
+                    bounds[1] <= group_bounds[3] + distance and bounds[3] >= group_bounds[1] - distance)
+            if (near and len(group['entries']) < max_size and
+                    union[2] - union[0] <= max_span and union[3] - union[1] <= max_span):
+                group['bounds'] = union
+                group['entries'].append(entry)
+                break
+        else:
+            groups.append({'bounds': bounds, 'entries': [entry]})
+    return groups
+
+def build_group(group):
+    """Build one group's levels in this process and return a report row per level."""
+    if len(group['entries']) > 1:
+        group_box = gpd.GeoDataFrame({'geometry': [box(*group['bounds'])]}, crs=MAIN_CRS)
+        for prefetch in (prefetch_vectors, prefetch_dem):
+            try:
+                prefetch(group_box)
+            except Exception as e:
+                # Each level falls back to its own queries and reads
+                print("Prefetch for group {} failed: {}".format(group['bounds'], e))
+
+    rows = []
+    try:
+        for entry in group['entries']:
+            start = time.perf_counter()
+            row = {'name': entry['name']}
+            try:
+                build_level(entry)
+                row['state'] = 'done'
+            except Exception as e:
+                row['state'] = 'failed'
+                row['error'] = str(e)
+            row['seconds'] = round(time.perf_counter() - start, 3)
+            rows.append(row)
+    finally:
+        # Worker processes are reused; drop the group's DEM before the next group
+        data_service.release_dem()
+    return rows
+
+def failed_rows(group, error):
+    return [{'name': entry['name'], 'state': 'failed', 'error': str(error)} for entry in group['entries']]
+
+def summarize(rows, groups, wall_seconds):
+    states = [row['state'] for row in rows]
+    return {
+        'levels': len(rows),
+        'groups': len(groups),
+        'done': states.count('done'),
+        'failed': states.count('failed'),
+        'pending': len(states) - states.count('done') - states.count('failed'),
+        'wallSeconds': round(wall_seconds, 3),
+        'levelSeconds': round(sum(row.get('seconds', 0) for row in rows), 3),
+        'results': sorted(rows, key=lambda row: row['name']),
+    }
+
+def run_batch(entries, max_workers=BATCH_WORKERS, report_path=REPORT_PATH):
+    validate_entries(entries)
+    start = time.perf_counter()
+    # Loaded here so forked workers inherit it instead of each reading the sources
+    if not base_rasters_available() and not data_service.data_loaded:
+        data_service.load_base_data()
+    for entry in entries:
+        create_level(entry)
+    groups = group_requests(entries)
+    print("Building {} levels in {} groups on {} workers".format(len(entries), len(groups), max_workers))
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(build_group, group): group for group in groups}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                rows.extend(failed_rows(futures[future], future.exception()))
+            else:
+                rows.extend(future.result())
+            print("{} of {} levels finished".format(len(rows), len(entries)))
+
+    report = summarize(rows, groups, time.perf_counter() - start)
+    if report_path:
+        write_metadata(report_path, report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build many levels in one run.')
+    parser.add_argument('levels', help='JSON file with a list of {name, centerPoint, boundHeight}')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS)
+    parser.add_argument('--report', default=REPORT_PATH, help='Where to write the summary report')
+    args = parser.parse_args()
+    with open(args.levels) as f:
+        entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries.get('levels')
+    report = run_batch(entries, args.workers, args.report)
+    for row in report['results']:
+        print("{:<32} {:<8} {:>8}s {}".format(row['name'], row['state'], row.get('seconds', ''), row.get('error', '')))
+    print("{done} done, {failed} failed in {wallSeconds}s ({levelSeconds}s of level time)".format(**report))
@@ -0,0 +1,243 @@
+"""
+Offline benchmarks for the level pipeline, run on synthetic data.
+
+    python benchmarks/run_benchmarks.py [--size small|medium|large] [--repeat 3]
+                                        [--save-baseline] [--check] [--tolerance 0.25]
+
+Each stage is timed over the same synthetic bounding boxes; the best of --repeat runs
+is reported with its throughput and the process's peak RSS while it ran. Results are
+compared with benchmarks/baselines/<size>.json when one exists. --save-baseline writes
+the current results there, and --check exits non-zero when a stage is slower than the
+baseline by more than the tolerance, or when there is no baseline to check against.
+Baselines are only comparable on the machine that recorded them, so none are committed;
+record one with --save-baseline before using --check.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+import numpy as np
+import rasterio
+import geopandas as gpd
+from shapely.geometry import box
+from synthetic_data import SIZES, benchmark_boxes, generate
+from profiling import profiled_level
+
+BENCHMARK_ROOT = os.environ.get('HABITAT_BENCHMARK_ROOT', os.path.join(tempfile.gettempdir(), 'habitat-benchmarks'))
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+DEFAULT_TOLERANCE = 0.25
+RESOLUTION = 15 / 111000
+
+
+def measure(run, repeat):
+    """Run run() repeat times; return its counts, the best time and the highest peak RSS."""
+    best_seconds, peak_mb, counts = None, None, None
+    for _ in range(repeat):
+        gc.collect()
+        # Level builds reset the peak counter per stage; the profile collects their peaks
+        with profiled_level() as profile:
+            start = time.perf_counter()
+            counts = run()
+            seconds = time.perf_counter() - start
+        peak_mb = max(peak_mb or 0, profile.level_peak_rss_mb())
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+    return counts, best_seconds, peak_mb
+
+def prepare(size, seed):
+    root = os.path.join(BENCHMARK_ROOT, size)
+    summary_path = os.path.join(root, 'data', 'synthetic.json')
+    summary = None
+    if os.path.exists(summary_path):
+        with open(summary_path) as f:
+            summary = json.load(f)
+    if summary is None or summary.get('seed') != seed:
+        print("Generating {} synthetic data in {}".format(size, root))
+        summary = generate(root, size, seed)
+    # The backend resolves ../data, ../levels and ../cache against its working directory
+    os.chdir(os.path.join(root, 'work'))
+    return root, summary
+
+def stage_benchmarks(root, size):
+    # Imported after chdir so module-level state matches the synthetic tree
+    from base_rasters import SOIL_LAYERS
+    from load_data import DataService
+    from level_builder import build_level, load_constants, data_service as level_data_service
+    from raster import rasterize_layers, print_raster_stack
+    from water_layers import build_water_layers
+    from water_mask import rasterize_water
+    from weather import get_weather_data
+
+    constants = load_constants()
+    boxes = [gpd.GeoDataFrame({'geometry': [box(*bounds)]}, crs='EPSG:4326') for bounds in benchmark_boxes(size)]
+    data_service = DataService()
+    data_service.load_base_data()
+    soils = [data_service.load_soil_data(bounding_box) for bounding_box in boxes]
+    water = [(data_service.load_flowlines(bounding_box), data_service.load_waterbodies(bounding_box)) for bounding_box in boxes]
+    dems = [data_service.load_dem_data(bounding_box, RESOLUTION) for bounding_box in boxes]
+    masks = [rasterize_water(flowlines, waterbodies, transform, dem.shape) for (flowlines, waterbodies), (dem, transform) in zip(water, dems)]
+    grid_pixels = sum(dem.size for dem, _ in dems)
+    level_data_service.load_base_data()
+    output_dir = os.path.join(root, 'output')
+
+    def load_base_data():
+        service = DataService()
+        service.load_base_data()
+        return {'features': len(service.spatial_gdf) + len(service.flowlines_gdf) + len(service.waterbodies_gdf)}
+
+    def soil_query():
+        return {'features': sum(len(data_service.load_soil_data(bounding_box)) for bounding_box in boxes)}
+
+    def water_query():
+        return {'features': sum(len(data_service.load_flowlines(bounding_box)) + len(data_service.load_waterbodies(bounding_box))
+                                for bounding_box in boxes)}
+
+    def dem_load():
+        return {'pixels': sum(data_service.load_dem_data(bounding_box, RESOLUTION)[0].size for bounding_box in boxes)}
+
+    def rasterize_soil():
+        for soils_gdf, (dem, transform) in zip(soils, dems):
+            rasterize_layers(soils_gdf, SOIL_LAYERS, RESOLUTION, {'taxorder': constants['soil_type_mapping']}, transform, dem.shape)
+        return {'pixels': grid_pixels, 'features': sum(len(soils_gdf) for soils_gdf in soils)}
+
+    def rasterize_water_mask():
+        for (flowlines, waterbodies), (dem, transform) in zip(water, dems):
+            rasterize_water(flowlines, waterbodies, transform, dem.shape)
+        return {'pixels': grid_pixels, 'features': sum(len(lines) + len(bodies) for lines, bodies in water)}
+
+    def water_layers():
+        for mask, (dem, _) in zip(masks, dems):
+            build_water_layers(dem, mask)
+        return {'pixels': grid_pixels}
+
+    def raster_outputs():
+        for index, (dem, transform) in enumerate(dems):
+            stack = np.repeat(dem[np.newaxis], 12, axis=0)
+            titles = ['band{}'.format(band) for band in range(len(stack))]
+            os.makedirs(os.path.join(output_dir, str(index)), exist_ok=True)
+            print_raster_stack(stack, transform, titles, os.path.join(output_dir, str(index)))
+        return {'pixels': grid_pixels * 12}
+
+    def weather():
+        for bounds in benchmark_boxes(size):
+            get_weather_data(list(bounds))
+        return {'features': len(boxes)}
+
+    def level_build():
+        # A cold build each time: no cached vectors, DEM windows or levels
+        shutil.rmtree(os.path.join(root, 'cache'), ignore_errors=True)
+        for index, bounds in enumerate(benchmark_boxes(size)):
+            center_y, half = (bounds[1] + bounds[3]) / 2, (bounds[3] - bounds[1]) / 2
+            build_level({'name': 'benchmark-{}'.format(index), 'centerPoint': [center_y, (bounds[0] + bounds[2]) / 2],
+                         'boundHeight': half})
+        return {'pixels': grid_pixels}
+
+    return [
+        ('load_base_data', load_base_data),
+        ('soil_query', soil_query),
+        ('water_query', water_query),
+        ('dem_load', dem_load),
+        ('rasterize_soil', rasterize_soil),
+        ('rasterize_water', rasterize_water_mask),
+        ('water_layers', water_layers),
+        ('print_raster_stack', raster_outputs),
+        ('weather', weather),
+        ('build_level', level_build),
+    ]
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'geopandas': gpd.__version__,
+        'rasterio': rasterio.__version__,
+        'gdal': rasterio.__gdal_version__,
+    }
+
+def run(size, repeat, seed, only=None):
+    root, summary = prepare(size, seed)
+    results = {'size': size, 'seed': seed, 'data': summary, 'environment': environment(), 'stages': {}}
+    for name, benchmark in stage_benchmarks(root, size):
+        if only and name not in only:
+            continue
+        counts, seconds, peak_mb = measure(benchmark, repeat)
+        result = {'seconds': round(seconds, 4), 'peakRssMb': peak_mb}
+        for unit, count in counts.items():
+            result[unit] = count
+            result['{}PerSecond'.format(unit)] = round(count / seconds, 1) if seconds > 0 else None
+        results['stages'][name] = result
+    return results
+
+def baseline_path(size):
+    return os.path.join(BASELINE_DIR, '{}.json'.format(size))
+
+def compare(results, baseline, tolerance):
+    """Return (stage, baseline seconds, seconds, ratio, regressed) for stages in both runs."""
+    rows = []
+    for name, result in results['stages'].items():
+        previous = baseline['stages'].get(name)
+        if previous is None or not previous['seconds']:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        rows.append((name, previous['seconds'], result['seconds'], ratio, ratio > 1 + tolerance))
+    return rows
+
+def print_results(results, comparison):
+    ratios = {row[0]: row for row in comparison}
+    print("{:<20} {:>9} {:>14} {:>14} {:>9} {:>9}".format('stage', 'seconds', 'pixels/s', 'features/s', 'peak MB', 'vs base'))
+    for name, result in results['stages'].items():
+        ratio = ''
+        if name in ratios:
+            ratio = '{:.2f}x{}'.format(ratios[name][3], ' !' if ratios[name][4] else '')
+        print("{:<20} {:>9.4f} {:>14} {:>14} {:>9} {:>9}".format(
+            name, result['seconds'], result.get('pixelsPerSecond', ''), result.get('featuresPerSecond', ''),
+            result['peakRssMb'] or '', ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the level pipeline on synthetic data.')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage', action='append', help='Only run this stage (repeatable)')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='Exit 1 if a stage regressed past the tolerance')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+    if args.check and not os.path.exists(baseline_path(args.size)):
+        # Nothing to compare with would otherwise pass every check
+        sys.exit("No baseline at {}; record one with --save-baseline first".format(baseline_path(args.size)))
+
+    results = run(args.size, args.repeat, args.seed, args.stage)
+    comparison = []
+    if os.path.exists(baseline_path(args.size)):
+        with open(baseline_path(args.size)) as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != results['environment']:
+            print("Baseline was recorded in a different environment; ratios are indicative only")
+        comparison = compare(results, baseline, args.tolerance)
+    print_results(results, comparison)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path(args.size), 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Saved baseline {}".format(baseline_path(args.size)))
+    regressions = [row[0] for row in comparison if row[4]]
+    if regressions:
+        print("Slower than baseline by more than {:.0%}: {}".format(args.tolerance, ', '.join(regressions)))
+        if args.check:
+            sys.exit(1)
@@ -0,0 +1,184 @@
+"""
+Synthetic stand-ins for the ../data sources, with the layers and columns DataService reads.
+
+    python benchmarks/synthetic_data.py <root> [--size small|medium|large]
+
+Writes <root>/data/{SSURGODB.gpkg, nhdplus_epasnapshot2022_or.gpkg, merged_dem.tif,
+WeatherDataMonthly.csv} and <root>/constants.json. Run the backend from <root>/work so
+its relative paths resolve to these files. The same size and seed always give the same data.
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from shapely.geometry import LineString, Point, box
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+from weather import weather_columns
+from load_data import SPATIAL_LAYER, FLOWLINES_LAYER, WATERBODIES_LAYER, EROMMA_LAYER
+
+CONSTANTS_SOURCE = os.path.join(os.path.dirname(BACKEND_DIR), 'constants.json')
+ORIGIN = (-124.4, 43.2)
+DEM_RESOLUTION = 1 / 3600
+SIZES = {
+    'small': {'extent': 0.4, 'soil_polygons': 400, 'flowlines': 40, 'waterbodies': 20, 'stations': 50, 'box': 0.03},
+    'medium': {'extent': 1.0, 'soil_polygons': 5000, 'flowlines': 400, 'waterbodies': 200, 'stations': 200, 'box': 0.08},
+    'large': {'extent': 2.0, 'soil_polygons': 40000, 'flowlines': 3000, 'waterbodies': 1500, 'stations': 800, 'box': 0.2},
+}
+# Horizon depths (cm) of each synthetic component
+HORIZONS = [(0, 20), (20, 50), (50, 100)]
+COMPONENTS_PER_MAP_UNIT = 2
+
+
+def extent_bounds(size):
+    extent = SIZES[size]['extent']
+    return ORIGIN[0], ORIGIN[1], ORIGIN[0] + extent, ORIGIN[1] + extent
+
+def benchmark_boxes(size, count=4):
+    """Deterministic level bounding boxes (minx, miny, maxx, maxy) spread over the extent."""
+    minx, miny, maxx, maxy = extent_bounds(size)
+    half = SIZES[size]['box']
+    rng = np.random.default_rng(1)
+    boxes = []
+    for _ in range(count):
+        x = rng.uniform(minx + 2 * half, maxx - 2 * half)
+        y = rng.uniform(miny + half, maxy - half)
+        width = half / np.cos(np.radians(y))
+        boxes.append((float(x - width), float(y - half), float(x + width), float(y + half)))
+    return boxes
+
+def write_soil(path, size, rng, taxorders):
+    minx, miny, maxx, maxy = extent_bounds(size)
+    count = SIZES[size]['soil_polygons']
+    points = shapely.points(rng.uniform(minx, maxx, count), rng.uniform(miny, maxy, count))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=box(minx, miny, maxx, maxy)))
+    cells = shapely.intersection(cells, box(minx, miny, maxx, maxy))
+    # Fewer map units than polygons, as in SSURGO where a map unit repeats across the survey
+    mukeys = rng.integers(0, max(count // 3, 1), len(cells)).astype(str)
+    gpd.GeoDataFrame({'mukey': mukeys}, geometry=cells, crs='EPSG:4326').to_file(path, layer=SPATIAL_LAYER, driver='GPKG')
+
+    unit_keys = np.unique(mukeys)
+    component_count = len(unit_keys) * COMPONENTS_PER_MAP_UNIT
+    component_df = pd.DataFrame({
+        'mukey': np.repeat(unit_keys, COMPONENTS_PER_MAP_UNIT),
+        'cokey': ['c{}'.format(index) for index in range(component_count)],
+        'comppct_r': np.tile([70, 30], len(unit_keys)),
+        'taxorder': rng.choice(taxorders + [None], component_count),
+        'map_l': 0.0, 'map_r': rng.uniform(200, 2500, component_count), 'map_h': 3000.0,
+        'airtempa_l': 0.0, 'airtempa_r': rng.uniform(2, 14, component_count), 'airtempa_h': 16.0,
+    })
+    horizon_count = component_count * len(HORIZONS)
+    chorizon_df = pd.DataFrame({
+        'chkey': ['h{}'.format(index) for index in range(horizon_count)],
+        'cokey': np.repeat(component_df['cokey'].to_numpy(), len(HORIZONS)),
+        'hzname': np.tile(['A', 'B', 'C'], component_count),
+        'hzdept_r': np.tile([top for top, _ in HORIZONS], component_count),
+        'hzdepb_r': np.tile([bottom for _, bottom in HORIZONS], component_count),
+        'om_r': rng.uniform(0, 8, horizon_count),
+        'sandtotal_r': rng.uniform(5, 90, horizon_count),
+        'silttotal_r': rng.uniform(5, 70, horizon_count),
+        'claytotal_r': rng.uniform(2, 45, horizon_count),
+    })
+    # Some horizons have no values, as in the real survey
+    missing = rng.random(horizon_count) < 0.1
+    chorizon_df.loc[missing, ['om_r', 'sandtotal_r', 'silttotal_r', 'claytotal_r']] = np.nan
+    fragment_df = pd.DataFrame({'chkey': chorizon_df['chkey'], 'fragvol_r': rng.uniform(0, 30, horizon_count)})
+
+    conn = sqlite3.connect(path)
+    component_df.to_sql('component', conn, index=False)
+    chorizon_df.to_sql('chorizon', conn, index=False)
+    fragment_df.to_sql('chfrags', conn, index=False)
+    conn.close()
+    return len(cells)
+
+def write_water(path, size, rng):
+    minx, miny, maxx, maxy = extent_bounds(size)
+    config = SIZES[size]
+    lines = []
+    for _ in range(config['flowlines']):
+        # Random walks drifting downhill to the west, 20-80 vertices each
+        steps = rng.normal([-0.002, 0.0], 0.0015, (rng.integers(20, 80), 2))
+        start = rng.uniform([minx, miny], [maxx, maxy])
+        lines.append(LineString(np.clip(start + np.cumsum(steps, axis=0), [minx, miny], [maxx, maxy])))
+    line_ids = np.arange(len(lines)) + 55000000000000
+    gpd.GeoDataFrame({'nhdplusid': line_ids}, geometry=lines, crs='EPSG:4326').to_file(
+        path, layer=FLOWLINES_LAYER, driver='GPKG')
+
+    centers = rng.uniform([minx, miny], [maxx, maxy], (config['waterbodies'], 2))
+    radii = rng.uniform(0.0005, 0.005, config['waterbodies'])
+    bodies = [Point(center).buffer(radius, quad_segs=8) for center, radius in zip(centers, radii)]
+    gpd.GeoDataFrame({'nhdplusid': np.arange(len(bodies)) + 12000000000000}, geometry=bodies, crs='EPSG:4326').to_file(
+        path, layer=WATERBODIES_LAYER, driver='GPKG')
+
+    # Flow table with a few ids repeated and a few flowlines missing, as in EROMMA
+    flow_ids = np.concatenate([line_ids[:int(len(line_ids) * 0.95)], line_ids[:5]])
+    gpd.GeoDataFrame({'nhdplusid': flow_ids, 'qe': rng.lognormal(4, 2, len(flow_ids))}, geometry=[None] * len(flow_ids),
+                     crs='EPSG:4326').to_file(
+        path, layer=EROMMA_LAYER, driver='GPKG')
+    return len(lines) + len(bodies)
+
+def write_dem(path, size, rng):
+    minx, miny, maxx, maxy = extent_bounds(size)
+    # Padded so boxes near the edge of the vector data still fall inside the DEM
+    pad = 0.05
+    width = int(round((maxx - minx + 2 * pad) / DEM_RESOLUTION))
+    height = int(round((maxy - miny + 2 * pad) / DEM_RESOLUTION))
+    transform = from_origin(minx - pad, maxy + pad, DEM_RESOLUTION, DEM_RESOLUTION)
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                       crs='EPSG:4326', transform=transform, tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate') as dst:
+        # Rising inland from below sea level on the west edge, with hills and noise
+        for row in range(0, height, 256):
+            rows = min(256, height - row)
+            y = (row + np.arange(rows))[:, None] / height
+            x = np.arange(width)[None, :] / width
+            surface = -20 + 600 * x + 80 * np.sin(12 * x) * np.cos(9 * y) + rng.normal(0, 2, (rows, width))
+            dst.write(surface.astype(np.float32), 1, window=rasterio.windows.Window(0, row, width, rows))
+    return width * height
+
+def write_weather(path, size, rng):
+    minx, miny, maxx, maxy = extent_bounds(size)
+    count = SIZES[size]['stations']
+    columns = weather_columns()
+    weather_df = pd.DataFrame(rng.uniform(0, 30, (count, len(columns))), columns=columns)
+    weather_df['Lon_DD'] = rng.uniform(minx, maxx, count)
+    weather_df['Lat_DD'] = rng.uniform(miny, maxy, count)
+    weather_df.to_csv(path, index=False)
+
+def generate(root, size='small', seed=0):
+    """Write a synthetic data set under root and return a summary of what was written."""
+    data_dir = os.path.join(root, 'data')
+    shutil.rmtree(data_dir, ignore_errors=True)
+    for directory in ['data', 'work', 'levels']:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    shutil.copy(CONSTANTS_SOURCE, os.path.join(root, 'constants.json'))
+    with open(CONSTANTS_SOURCE) as f:
+        taxorders = [name for name in json.load(f)['constants']['soil_type_mapping'] if name not in ('Unknown', 'None')]
+
+    rng = np.random.default_rng(seed)
+    summary = {'size': size, 'seed': seed}
+    summary['soilPolygons'] = write_soil(os.path.join(data_dir, 'SSURGODB.gpkg'), size, rng, taxorders)
+    summary['waterFeatures'] = write_water(os.path.join(data_dir, 'nhdplus_epasnapshot2022_or.gpkg'), size, rng)
+    summary['demPixels'] = write_dem(os.path.join(data_dir, 'merged_dem.tif'), size, rng)
+    write_weather(os.path.join(data_dir, 'WeatherDataMonthly.csv'), size, rng)
+    with open(os.path.join(data_dir, 'synthetic.json'), 'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic data set for benchmarks.')
+    parser.add_argument('root')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.root, args.size, args.seed))
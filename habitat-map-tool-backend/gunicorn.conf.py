@@ -0,0 +1,34 @@
+"""
+Gunicorn settings for serving the backend.
+
+    HABITAT_SHARED_DATA=1 HABITAT_WARM_UP=1 gunicorn backend:app
+
+The app is imported and its base data loaded once in the master. The web worker and
+its level-build pool are forked afterwards, so they share those pages instead of each
+loading a copy. With HABITAT_SHARED_DATA=1 the vector layers are memory-mapped files,
+which stay shared whatever the processes do with them.
+
+Job state (the JobQueue's jobs, batches, dedup, pending limit and /metrics) lives in
+the web worker's memory, so there is one worker process by default. It serves requests
+concurrently on HABITAT_WEB_THREADS threads, while builds run in its process pool
+(HABITAT_MAX_WORKERS). With HABITAT_WEB_WORKERS above 1, every worker has its own
+queue and pool: job status is only found on the worker that accepted the job, and
+dedup, the pending limit and /metrics apply per worker.
+"""
+import os
+
+bind = os.environ.get('HABITAT_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('HABITAT_WEB_WORKERS', 1))
+threads = int(os.environ.get('HABITAT_WEB_THREADS', 4))
+preload_app = True
+# Level builds run in the worker's process pool, so requests themselves stay short
+timeout = 120
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any worker is forked
+    from backend import preload
+    preload()
+    if workers > 1:
+        server.log.warning("HABITAT_WEB_WORKERS=%s: job state is not shared between workers, so job status, "
+                           "dedup and the pending limit are per worker", workers)
@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from level_builder import build_level, create_level, level_metadata_path, mark_failed
+from batch import build_group, failed_rows, group_requests, summarize, validate_entries
+from profiling import StageMetrics
+
+MAX_WORKERS = int(os.environ.get('HABITAT_MAX_WORKERS', 2))
+# Levels queued or running at once, counting each level of a batch; larger batches
+# should go through batch.py instead
+MAX_PENDING_JOBS = int(os.environ.get('HABITAT_MAX_PENDING_JOBS', 16))
+MAX_FINISHED_JOBS = 256
+MAX_FINISHED_BATCHES = 64
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def read_metadata(metadata_path):
+    # Workers replace metadata.json atomically, but the level may not exist yet or be being removed
+    try:
+        with open(metadata_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fail_level(name, error):
+    metadata_path = level_metadata_path(name)
+    metadata = read_metadata(metadata_path)
+    if metadata is not None:
+        mark_failed(metadata, metadata_path, error)
+
+
+class JobQueue:
+    """
+    Runs level builds in a bounded process pool.
+
+    Each level name has at most one active job: resubmitting a level that is still
+    queued or running returns the existing job id. Levels submitted in a batch are
+    jobs too, sharing their group's future, so they count towards max_pending and
+    take part in the same check. Progress is read back from the stage the worker
+    records in the level's metadata.json.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING_JOBS):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.batches = OrderedDict()
+        self.active_by_name = {}
+        self.lock = threading.Lock()
+        self.metrics = StageMetrics()
+
+    def _get_executor(self):
+        # Created lazily so workers fork after any warm-up in the parent process
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    def _submit_to_pool(self, names, fn, *args):
+        """
+        Submit fn to the pool, replacing the pool once if a dead worker has broken it.
+        The levels in names are marked failed if the build never starts or its worker dies.
+        """
+        for _ in range(2):
+            try:
+                future = self._get_executor().submit(fn, *args)
+                break
+            except BrokenProcessPool:
+                print("Worker pool is broken; starting a new one")
+                self.executor.shutdown(wait=False)
+                self.executor = None
+        else:
+            error = "Worker pool is unavailable"
+            for name in names:
+                fail_level(name, error)
+            raise QueueFullError(error)
+        future.add_done_callback(lambda future: self._record_dead_worker(future, names))
+        return future
+
+    def _record_dead_worker(self, future, names):
+        # Builds that raise mark their own level failed; a killed worker cannot
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            for name in names:
+                fail_level(name, "The worker building this level died: {}".format(future.exception()))
+
+    def _active_job(self, name):
+        # Called with the lock held; the job may have been pruned since it was registered
+        job_id = self.active_by_name.get(name)
+        if job_id is not None and job_id in self.jobs and not self.jobs[job_id]['future'].done():
+            return job_id
+        return None
+
+    def _check_capacity(self, count):
+        # Called with the lock held
+        active_count = sum(1 for job in self.jobs.values() if not job['future'].done())
+        if active_count + count > self.max_pending:
+            raise QueueFullError("Job queue is full ({} active jobs, {} more requested)".format(active_count, count))
+
+    def submit(self, data):
+        name = data['name']
+        with self.lock:
+            active_id = self._active_job(name)
+            if active_id is not None:
+                return active_id, True
+            self._check_capacity(1)
+
+            metadata = create_level(data)
+            job_id = uuid.uuid4().hex
+            future = self._submit_to_pool([name], build_level, data, metadata)
+            future.add_done_callback(self._record_metrics)
+            self.jobs[job_id] = {'name': name, 'future': future}
+            self.active_by_name[name] = job_id
+            self._prune_finished()
+        return job_id, False
+
+    def submit_batch(self, entries):
+        """
+        Queue a list of level requests, built in groups of nearby levels. Levels
+        that already have an active job are left to it and returned as
+        {name: job_id}; the rest must fit within max_pending.
+        """
+        validate_entries(entries)
+        with self.lock:
+            duplicates = {}
+            new_entries = []
+            for entry in entries:
+                active_id = self._active_job(entry['name'])
+                if active_id is not None:
+                    duplicates[entry['name']] = active_id
+                else:
+                    new_entries.append(entry)
+            self._check_capacity(len(new_entries))
+
+            for entry in new_entries:
+                create_level(entry)
+            groups = group_requests(new_entries) if new_entries else []
+            batch_id = uuid.uuid4().hex
+            futures = []
+            for group in groups:
+                future = self._submit_to_pool([entry['name'] for entry in group['entries']], build_group, group)
+                futures.append(future)
+                for entry in group['entries']:
+                    job_id = uuid.uuid4().hex
+                    self.jobs[job_id] = {'name': entry['name'], 'future': future, 'batchId': batch_id}
+                    self.active_by_name[entry['name']] = job_id
+            self.batches[batch_id] = {'groups': groups, 'futures': futures, 'duplicates': duplicates,
+                                      'start': time.time(), 'end': None}
+            finished = [key for key, batch in self.batches.items() if all(future.done() for future in batch['futures'])]
+            for key in finished[:max(0, len(finished) - MAX_FINISHED_BATCHES)]:
+                del self.batches[key]
+            self._prune_finished()
+        return batch_id, len(groups), duplicates
+
+    def batch_status(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        rows = []
+        for group, future in zip(batch['groups'], batch['futures']):
+            if not future.done():
+                state = 'running' if future.running() else 'queued'
+                rows.extend({'name': entry['name'], 'state': state} for entry in group['entries'])
+            elif future.exception() is not None:
+                rows.extend(failed_rows(group, future.exception()))
+            else:
+                rows.extend(future.result())
+        done = all(future.done() for future in batch['futures'])
+        if done and batch['end'] is None:
+            batch['end'] = time.time()
+        status = summarize(rows, batch['groups'], (batch['end'] or time.time()) - batch['start'])
+        status['batchId'] = batch_id
+        status['state'] = 'done' if done else 'running'
+        status['duplicates'] = batch['duplicates']
+        return status
+
+    def _record_metrics(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        timings = future.result().get('timings')
+        if timings:
+            self.metrics.observe_timings(timings)
+
+    def render_metrics(self):
+        with self.lock:
+            active = sum(1 for job in self.jobs.values() if not job['future'].done())
+        lines = [
+            '# TYPE habitat_jobs_active gauge',
+            'habitat_jobs_active {}'.format(active),
+        ]
+        return '\n'.join(lines) + '\n' + self.metrics.render()
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['future'].done()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = {'jobId': job_id, 'name': job['name']}
+        if 'batchId' in job:
+            status['batchId'] = job['batchId']
+        metadata = read_metadata(level_metadata_path(job['name']))
+        if metadata is not None:
+            status['stage'] = metadata.get('stage')
+            status['progress'] = metadata.get('progress')
+            status['hasBeenProcessed'] = metadata.get('hasBeenProcessed', False)
+
+        future = job['future']
+        if not future.done():
+            status['state'] = 'running' if future.running() else 'queued'
+        elif future.exception() is not None:
+            status['state'] = 'failed'
+            status['error'] = str(future.exception())
+        elif 'batchId' in job:
+            # A batch job's future is its group's; pick this level's report row
+            row = next(row for row in future.result() if row['name'] == job['name'])
+            status['state'] = row['state']
+            if 'error' in row:
+                status['error'] = row['error']
+        else:
+            status['state'] = 'done'
+        return status
@@ -0,0 +1,71 @@
+import water_layers
+import water_mask
+from load_data import SOILDB_PATH, DEM_PATH, WATERDB_PATH
+from result_cache import hash_key, source_versions
+from weather import WEATHER_PATH
+
+# Direct inputs of every node a level build computes. Names that are not nodes themselves
+# are plain inputs, resolved by level_inputs(). water_mask is intermediate (never written
+# out) and weather is the tempData/precipData metadata rather than a raster.
+LAYER_DEPENDENCIES = {
+    'dem': ['grid', 'dem_source'],
+    'precip': ['grid', 'soil_source'],
+    'silt': ['grid', 'soil_source'],
+    'clay': ['grid', 'soil_source'],
+    'sand': ['grid', 'soil_source'],
+    'organic': ['grid', 'soil_source'],
+    'rock': ['grid', 'soil_source'],
+    'temp': ['grid', 'soil_source'],
+    'soil': ['grid', 'soil_source', 'soil_type_mapping'],
+    'water_mask': ['dem', 'water_source', 'water_mask_params'],
+    'adjusted_dem': ['dem', 'water_mask', 'water_layer_params'],
+    'water': ['dem', 'water_mask', 'water_layer_params'],
+    'flood': ['dem', 'water_mask', 'water_layer_params'],
+    'weather': ['grid', 'weather_source'],
+}
+
+
+def level_inputs(bounds, resolution, constants):
+    return {
+        'grid': [[round(value, 9) for value in bounds], resolution],
+        'dem_source': source_versions([DEM_PATH]),
+        'soil_source': source_versions([SOILDB_PATH]),
+        'soil_type_mapping': constants['soil_type_mapping'],
+        'water_source': source_versions([WATERDB_PATH]),
+        'water_mask_params': [water_mask.FLOW_SCALED_STROKES, water_mask.FLOW_PER_STROKE_PIXEL, water_mask.MAX_STROKE_PIXELS],
+        'water_layer_params': [water_layers.BUFFER_DISTANCE, water_layers.FLOOD_BUFFER_DISTANCE, water_layers.PIXEL_SIZE,
+                               water_layers.MAX_ELEVATION_DIFF],
+        'weather_source': source_versions([WEATHER_PATH]),
+    }
+
+def node_hashes(inputs):
+    """
+    Hash every node from its own inputs and its dependencies' hashes, so a change
+    anywhere upstream changes the hash of everything downstream of it.
+    """
+    hashes = {}
+    def resolve(node):
+        if node not in LAYER_DEPENDENCIES:
+            return hash_key(node, inputs[node])
+        if node not in hashes:
+            hashes[node] = hash_key(node, [resolve(dependency) for dependency in LAYER_DEPENDENCIES[node]])
+        return hashes[node]
+    for node in LAYER_DEPENDENCIES:
+        resolve(node)
+    return hashes
+
+def stale_nodes(hashes, previous_hashes, missing=()):
+    """Nodes whose hash differs from the one recorded at the last build, plus any whose output is missing."""
+    return {node for node in hashes if previous_hashes.get(node) != hashes[node] or node in missing}
+
+def required_nodes(nodes):
+    """nodes and everything they are computed from."""
+    required = set()
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        if node in required or node not in LAYER_DEPENDENCIES:
+            continue
+        required.add(node)
+        pending.extend(LAYER_DEPENDENCIES[node])
+    return required
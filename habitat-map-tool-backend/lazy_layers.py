@@ -0,0 +1,71 @@
+import math
+from collections import OrderedDict
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+MAIN_CRS = 'EPSG:4326'
+TILE_SIZE = 0.25
+MAX_CACHED_TILES = 64
+
+
+class TileCache:
+    """Least-recently-used cache of GeoDataFrame tiles shared by all lazy layers."""
+
+    def __init__(self, max_tiles=MAX_CACHED_TILES):
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.tiles:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tiles.move_to_end(key)
+        return self.tiles[key]
+
+    def put(self, key, tile_gdf):
+        self.tiles[key] = tile_gdf
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+
+class LazyLayer:
+    """
+    A GeoPackage layer read on demand, one fixed-size tile at a time.
+
+    Tiles are aligned to a TILE_SIZE degree grid in MAIN_CRS and fetched with a
+    bbox read, which GDAL answers from the GeoPackage's rtree index. Features that
+    straddle tile edges are de-duplicated by their fid.
+    """
+
+    def __init__(self, path, layer, cache, tile_size=TILE_SIZE):
+        self.path = path
+        self.layer = layer
+        self.cache = cache
+        self.tile_size = tile_size
+
+    def tile_keys(self, bounding_box):
+        minx, miny, maxx, maxy = bounding_box.to_crs(MAIN_CRS).total_bounds
+        cols = range(math.floor(minx / self.tile_size), math.floor(maxx / self.tile_size) + 1)
+        rows = range(math.floor(miny / self.tile_size), math.floor(maxy / self.tile_size) + 1)
+        return [(self.path, self.layer, col, row) for col in cols for row in rows]
+
+    def read_tile(self, key):
+        tile_gdf = self.cache.get(key)
+        if tile_gdf is None:
+            _, _, col, row = key
+            tile_box = box(col * self.tile_size, row * self.tile_size,
+                           (col + 1) * self.tile_size, (row + 1) * self.tile_size)
+            tile_bbox = gpd.GeoDataFrame({'geometry': [tile_box]}, crs=MAIN_CRS)
+            tile_gdf = gpd.read_file(self.path, layer=self.layer, bbox=tile_bbox, fid_as_index=True)
+            self.cache.put(key, tile_gdf)
+        return tile_gdf
+
+    def read(self, bounding_box):
+        tiles = [self.read_tile(key) for key in self.tile_keys(bounding_box)]
+        layer_gdf = gpd.GeoDataFrame(pd.concat(tiles), crs=tiles[0].crs)
+        return layer_gdf[~layer_gdf.index.duplicated()]
@@ -0,0 +1,354 @@
+from raster import (rasterize_layers, print_raster_stack, normalize_output_formats, OUTPUT_FORMATS,
+                    OUTPUT_FORMAT_CHOICES, COG_FILE_NAME, target_grid)
+from water_mask import rasterize_water
+from weather import get_weather_data
+import geopandas as gpd
+from shapely.geometry import box
+from load_data import DataService
+from base_rasters import SOIL_LAYERS, base_rasters_available, read_soil_window, read_water_window
+from result_cache import ResultCache, CONSTANTS_PATH, hash_key
+from layer_graph import level_inputs, node_hashes, stale_nodes, required_nodes
+from level_index import LevelIndex
+from profiling import profiled_level, current_profile, stage
+from scratch import ScratchArena, check_memory_budget
+import time
+import math
+import json
+import os
+from water_layers import build_water_layers, build_water_layers_tiled, TILED_PIXEL_THRESHOLD
+import numpy as np
+from util import atomic_write
+LEVELS_DIR = '../levels'
+MAIN_CRS = 'EPSG:4326'
+
+# Output layers in stack order, and the metadata.json key each one's min/max is stored under
+LAYER_TITLES = ['dem', 'adjusted_dem', 'precip', 'silt', 'clay', 'sand', 'organic', 'rock', 'temp', 'soil', 'water', 'flood']
+LAYER_METADATA_KEYS = {
+    'dem': 'dem', 'adjusted_dem': 'adjustedDem', 'precip': 'precip', 'silt': 'silt', 'clay': 'clay',
+    'sand': 'sand', 'organic': 'organic', 'rock': 'rock', 'temp': 'temp', 'water': 'water', 'flood': 'flood'
+}
+
+# Soil attribute layers, in SOIL_LAYERS order
+SOIL_TITLES = LAYER_TITLES[2:10]
+
+# Output grid resolution in degrees, about 15 m
+LEVEL_RESOLUTION = 15 / 111000
+
+# Stages a level build passes through, recorded as metadata['stage'] while it runs
+STAGES = ['queued', 'loading', 'rasterizing', 'water', 'reprojecting', 'weather', 'done']
+
+# Created on first use in each process; worker processes forked after warm-up inherit the loaded data.
+# HABITAT_SHARED_DATA=1 serves vector layers from memory-mapped files shared by all workers.
+data_service = DataService(lazy=os.environ.get('HABITAT_LAZY_DATA') == '1', shared=os.environ.get('HABITAT_SHARED_DATA') == '1')
+result_cache = ResultCache()
+level_index = LevelIndex(LEVELS_DIR)
+_constants_cache = {}
+
+
+def write_metadata(metadata_path, metadata):
+    # Written atomically so readers never see a half-written file
+    with atomic_write(metadata_path) as f:
+        json.dump(metadata,f,indent=4)
+
+def load_constants():
+    # Reread only when constants.json changes, so batches and long-lived workers parse it once
+    mtime = os.path.getmtime(CONSTANTS_PATH)
+    if _constants_cache.get('mtime') != mtime:
+        with open(CONSTANTS_PATH) as f:
+            _constants_cache.update(mtime=mtime, constants=json.load(f)['constants'])
+    return _constants_cache['constants']
+
+def level_bounds(data):
+    """Bounding box [minx, miny, maxx, maxy] of a level request, in MAIN_CRS."""
+    x = data['centerPoint'][1]
+    y = data['centerPoint'][0]
+    height = data['boundHeight']
+    return [x - height / math.cos(y * math.pi/180), y - height, x + height / math.cos(y * math.pi/180), y + height]
+
+def set_stage(metadata, metadata_path, stage):
+    metadata['stage'] = stage
+    metadata['progress'] = STAGES.index(stage) / (len(STAGES) - 1)
+    write_metadata(metadata_path, metadata)
+    level_index.update(metadata['name'], metadata)
+
+def level_metadata_path(name):
+    return os.path.join(LEVELS_DIR, name, 'metadata.json')
+
+def create_level(data):
+    level_path = os.path.join(LEVELS_DIR, data['name'])
+    if not os.path.exists(level_path):
+        # create the level directory
+        os.makedirs(level_path)
+
+    metadata = {
+        "name": data['name'],
+        "id": data['name'],
+        "centerPoint": data['centerPoint'],
+        "boundHeight": data['boundHeight'],
+        "hasBeenProcessed": False
+    }
+    # A refresh starts from the last build's metadata so its layer hashes and stats carry over
+    metadata_path = level_metadata_path(data['name'])
+    if data.get('refresh') and os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as f:
+            previous = json.load(f)
+        if previous.get('hasBeenProcessed'):
+            previous.pop('error', None)
+            metadata = dict(previous, **metadata)
+            metadata['hasBeenProcessed'] = True
+    set_stage(metadata, level_metadata_path(data['name']), 'queued')
+    return metadata
+
+def build_level(data, metadata=None):
+    """Run the full level pipeline for one /process request and return the final metadata."""
+    if metadata is None:
+        metadata = create_level(data)
+    metadata_path = level_metadata_path(data['name'])
+    # Opt in to a cProfile dump per job with "profile": true in the request or HABITAT_PROFILE=1
+    profile_path = None
+    if data.get('profile') or os.environ.get('HABITAT_PROFILE') == '1':
+        profile_path = os.path.join(LEVELS_DIR, data['name'], 'profile.prof')
+    try:
+        with profiled_level(profile_path):
+            return _build_level(data, metadata, metadata_path)
+    except Exception as e:
+        mark_failed(metadata, metadata_path, e)
+        raise
+
+def mark_failed(metadata, metadata_path, error):
+    metadata['stage'] = 'failed'
+    metadata['error'] = str(error)
+    write_metadata(metadata_path, metadata)
+    level_index.update(metadata['name'], metadata)
+
+def cached_vector(kind, bounding_box, load):
+    gdf = result_cache.get_vector(kind, bounding_box)
+    if gdf is None:
+        gdf = load(bounding_box)
+        result_cache.put_vector(kind, bounding_box, gdf)
+    return gdf
+
+def prefetch_vectors(bounding_box):
+    """
+    Query soil and water for a box covering several levels and cache the results;
+    the per-level queries inside it are then served by clipping the cached frames.
+    """
+    if base_rasters_available():
+        return
+    if (not data_service.data_loaded):
+        data_service.load_base_data()
+    cached_vector('soil', bounding_box, data_service.load_soil_data)
+    cached_vector('flowlines', bounding_box, data_service.load_flowlines)
+    cached_vector('waterbodies', bounding_box, data_service.load_waterbodies)
+
+def prefetch_dem(bounding_box):
+    """
+    Read the DEM for a box covering several levels once; levels inside it are
+    resampled from that array until release_dem() is called on data_service.
+    """
+    data_service.prefetch_dem(bounding_box, LEVEL_RESOLUTION)
+
+def level_output_files(output_formats):
+    """Files a complete level has in its directory, besides metadata.json."""
+    files = []
+    if 'png' in output_formats:
+        files.extend('{}.png'.format(title) for title in LAYER_TITLES)
+    if 'cog' in output_formats:
+        files.append(COG_FILE_NAME)
+    return files
+
+def remove_unrequested_outputs(level_path, metadata, output_formats):
+    """
+    Delete outputs of formats this build did not write, so a refresh with fewer
+    formats does not leave files from an older build next to the new ones.
+    """
+    requested = set(level_output_files(output_formats))
+    for file_name in level_output_files(OUTPUT_FORMAT_CHOICES):
+        if file_name not in requested:
+            try:
+                os.remove(os.path.join(level_path, file_name))
+            except FileNotFoundError:
+                pass
+    if 'cog' not in output_formats:
+        metadata.pop('cog', None)
+
+def missing_outputs(level_path, metadata, output_formats):
+    """Nodes whose outputs are absent from the level directory or metadata, and so need writing even if fresh."""
+    missing = set()
+    for title in LAYER_TITLES:
+        if 'png' in output_formats and not os.path.exists(os.path.join(level_path, '{}.png'.format(title))):
+            missing.add(title)
+        if title in LAYER_METADATA_KEYS and LAYER_METADATA_KEYS[title] not in metadata:
+            missing.add(title)
+    if 'cog' in output_formats and not os.path.exists(os.path.join(level_path, COG_FILE_NAME)):
+        missing.update(LAYER_TITLES)
+    if 'tempData' not in metadata or 'precipData' not in metadata:
+        missing.add('weather')
+    return missing
+
+def _build_level(data, metadata, metadata_path):
+    name = data['name']
+    level_path = os.path.join(LEVELS_DIR, name)
+    constants = load_constants()
+    bounds = level_bounds(data)
+    minx, miny, maxx, maxy = bounds
+    
+    resolution = LEVEL_RESOLUTION
+    print("Bounding box: {} {} {} {}".format(minx, miny, maxx, maxy))
+    bounding_box = gpd.GeoDataFrame({'geometry': [box(minx, miny, maxx, maxy)]}, crs=MAIN_CRS)
+
+    start_time = time.time()    
+    output_formats = normalize_output_formats(data.get('outputFormats', OUTPUT_FORMATS))
+    with stage('cache_lookup'):
+        level_key = result_cache.level_key([minx, miny, maxx, maxy], resolution, output_formats)
+        cached_metadata = result_cache.get_level(level_key, level_path, metadata)
+    if cached_metadata is not None:
+        print("Level served from cache {}".format(level_key))
+        metadata.update(cached_metadata)
+        remove_unrequested_outputs(level_path, metadata, output_formats)
+        metadata['rebuiltLayers'] = []
+        metadata['timings'] = current_profile().to_metadata()
+        set_stage(metadata, metadata_path, 'done')
+        return metadata
+
+    # Each layer's hash covers its inputs and everything upstream; a refresh rebuilds only
+    # the layers whose hash changed since the last build, plus any with missing outputs
+    inputs = level_inputs(bounds, resolution, constants)
+    hashes = node_hashes(inputs)
+    previous_hashes = metadata.get('layerHashes', {}) if data.get('refresh') else {}
+    stale = stale_nodes(hashes, previous_hashes, missing_outputs(level_path, metadata, output_formats))
+    stale_titles = [title for title in LAYER_TITLES if title in stale]
+    print("Rebuilding {} of {} layers".format(len(stale_titles), len(LAYER_TITLES)))
+
+    metadata.setdefault('memory', {})
+    if stale_titles:
+        _build_rasters(data, metadata, metadata_path, bounding_box, resolution, constants,
+                       required_nodes(stale_titles), stale_titles, output_formats, hashes['water_mask'])
+    
+    if 'weather' in stale:
+        set_stage(metadata, metadata_path, 'weather')
+        with stage('weather'):
+            temp_data, precip_data = get_weather_data([minx, miny, maxx, maxy])
+        metadata['tempData'] = temp_data
+        metadata['precipData'] = precip_data
+    
+    print ("Total time: {}".format(time.time() - start_time))
+    metadata['hasBeenProcessed'] = True
+    metadata['inputHashes'] = { input_name: hash_key(input_name, value) for input_name, value in inputs.items() }
+    metadata['layerHashes'] = hashes
+    metadata['rebuiltLayers'] = stale_titles + (['weather'] if 'weather' in stale else [])
+    metadata['timings'] = current_profile().to_metadata()
+    metadata['memory']['peakRssMb'] = current_profile().level_peak_rss_mb()
+    remove_unrequested_outputs(level_path, metadata, output_formats)
+    print(metadata)
+    set_stage(metadata, metadata_path, 'done')
+    result_cache.put_level(level_key, level_path, level_output_files(output_formats))
+    return metadata
+
+def _build_rasters(data, metadata, metadata_path, bounding_box, resolution, constants, required, stale_titles, output_formats,
+                   water_mask_hash):
+    """Compute the required layers on the DEM grid and write out the stale ones."""
+    level_path = os.path.join(LEVELS_DIR, data['name'])
+    bounds = [float(value) for value in bounding_box.total_bounds]
+    soil_bands = [band for band, title in enumerate(SOIL_TITLES) if title in required]
+    needs_water = 'water_mask' in required
+
+    set_stage(metadata, metadata_path, 'loading')
+    # Statewide soil/water rasters, when built for the current sources, replace the vector queries
+    use_base_rasters = base_rasters_available()
+    # The water mask is cached under its layer hash, which covers the grid, the sources and the
+    # stroke parameters; a hit skips the water queries and rasterization
+    water_mask = None
+    if needs_water and not use_base_rasters:
+        water_mask = result_cache.get_water_mask(water_mask_hash)
+    query_water = needs_water and water_mask is None
+    if not use_base_rasters:
+        if (not data_service.data_loaded):
+            with stage('load_base_data'):
+                data_service.load_base_data()
+        if soil_bands:
+            with stage('soil_query') as record:
+                soils_gdf = cached_vector('soil', bounding_box, data_service.load_soil_data)
+                record['features'] = len(soils_gdf)
+            print("Soil data loaded")
+        if query_water:
+            with stage('water_query') as record:
+                flowlines_gdf = cached_vector('flowlines', bounding_box, data_service.load_flowlines)
+                waterbodies_gdf = cached_vector('waterbodies', bounding_box, data_service.load_waterbodies)
+                record['features'] = len(flowlines_gdf) + len(waterbodies_gdf)
+            print("Water data loaded")
+    
+    # DEM (already rasterized); always loaded since it defines the grid
+    dem = result_cache.get_array('dem', bounds, resolution)
+    if dem is None:
+        dem = data_service.load_dem_data(bounding_box, resolution)
+        result_cache.put_array('dem', bounds, resolution, dem)
+    dem_transform = dem[1]
+    print("DEM data loaded")
+
+    # Every layer is written straight into one float32 stack on the DEM grid, in LAYER_TITLES order
+    level_shape = dem[0].shape
+    grid = target_grid(dem_transform, level_shape)
+    metadata['memory']['budgetMb'] = check_memory_budget(dem[0].size, grid[1] * grid[2], len(stale_titles))
+    arena = ScratchArena()
+    layer_stack = arena.get('layers', (len(LAYER_TITLES),) + level_shape, np.float32)
+    layer_stack[0] = dem[0]
+    dem_raster = layer_stack[0]
+    del dem
+    adjusted_dem, soil_stack, water_raster, flood_raster = layer_stack[1], layer_stack[2:10], layer_stack[10], layer_stack[11]
+
+    set_stage(metadata, metadata_path, 'rasterizing')
+    if use_base_rasters:
+        with stage('base_raster_window', pixels=dem_raster.size, bands=len(SOIL_LAYERS)):
+            if soil_bands:
+                read_soil_window(dem_transform, level_shape, out=soil_stack)
+            if needs_water:
+                water_mask = read_water_window(dem_transform, level_shape)
+        print("Base raster windows read")
+    else:
+        # Soil and water are burned onto the DEM grid so every layer can be stacked
+        if soil_bands:
+            soil_out = soil_stack
+            if len(soil_bands) < len(SOIL_LAYERS):
+                soil_out = arena.get('soil_bands', (len(soil_bands),) + level_shape, np.float32)
+            with stage('rasterize_soil', features=len(soils_gdf), pixels=dem_raster.size, bands=len(soil_bands)):
+                rasterize_layers(soils_gdf, [SOIL_LAYERS[band] for band in soil_bands], resolution,
+                                 {'taxorder': constants['soil_type_mapping']}, dem_transform, level_shape, out=soil_out)
+            if soil_out is not soil_stack:
+                soil_stack[soil_bands] = soil_out
+            del soil_out
+        if query_water:
+            with stage('rasterize_water', features=len(flowlines_gdf) + len(waterbodies_gdf), pixels=dem_raster.size):
+                water_mask = rasterize_water(flowlines_gdf, waterbodies_gdf, dem_transform, level_shape)
+            result_cache.put_water_mask(water_mask_hash, water_mask)
+        print("Rasterization complete")
+
+    if needs_water:
+        water_mask[dem_raster <= 0] = 1
+        set_stage(metadata, metadata_path, 'water')
+        water_outputs = (adjusted_dem, water_raster, flood_raster)
+        with stage('water_layers', pixels=dem_raster.size) as record:
+            record['tiled'] = bool(dem_raster.size > TILED_PIXEL_THRESHOLD)
+            if record['tiled']:
+                build_water_layers_tiled(dem_raster, water_mask, out=water_outputs)
+            else:
+                build_water_layers(dem_raster, water_mask, out=water_outputs, arena=arena)
+        del water_mask
+
+    # Only the layer stack is still needed; free the soil and water temporaries before the
+    # reprojected stack is allocated
+    arena.release('soil_bands', 'water_count', 'depth', 'distance')
+    set_stage(metadata, metadata_path, 'reprojecting')
+    # All layers share the DEM grid, so they are reprojected together as one stack. On a
+    # partial rebuild only the stale bands are reprojected and swapped into the existing COG
+    output_stack = layer_stack
+    if len(stale_titles) < len(LAYER_TITLES):
+        output_stack = layer_stack[[LAYER_TITLES.index(title) for title in stale_titles]]
+    layer_stats = print_raster_stack(output_stack, dem_transform, stale_titles, level_path, grid=grid,
+                                     output_formats=output_formats, arena=arena, cog_titles=LAYER_TITLES)
+    metadata['memory']['scratchMb'] = round(arena.peak_nbytes / 1024 ** 2, 1)
+    for title, (min, max) in layer_stats.items():
+        if title in LAYER_METADATA_KEYS:
+            metadata[LAYER_METADATA_KEYS[title]] = { 'min': min, 'max': max }
+    if 'cog' in output_formats:
+        metadata['cog'] = { 'file': COG_FILE_NAME, 'bands': LAYER_TITLES }
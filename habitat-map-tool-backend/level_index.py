@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+INDEX_FILE_NAME = 'index.sqlite'
+# Fields of metadata.json served by /levels; the full file is served per level
+SUMMARY_FIELDS = ['name', 'id', 'centerPoint', 'boundHeight', 'hasBeenProcessed', 'stage', 'progress']
+# Seconds between rescans of the levels directory for changes made outside the API
+REFRESH_INTERVAL = float(os.environ.get('HABITAT_INDEX_REFRESH_SECONDS', 5))
+
+
+def level_summary(metadata):
+    return {field: metadata[field] for field in SUMMARY_FIELDS if field in metadata}
+
+
+class LevelIndex:
+    """
+    SQLite catalog of level summaries, one row per level directory.
+
+    Level builds update their row whenever they write metadata.json, from whichever
+    process runs them. Directories added, changed or removed by other means are picked
+    up by refresh(), which only reparses metadata.json files whose mtime changed.
+    """
+
+    def __init__(self, levels_dir, index_path=None, refresh_interval=REFRESH_INTERVAL):
+        self.levels_dir = levels_dir
+        self.index_path = index_path or os.path.join(levels_dir, INDEX_FILE_NAME)
+        self.refresh_interval = refresh_interval
+        self.last_refresh = None
+        self.lock = threading.Lock()
+        # Absolute path of the index file whose schema this instance has created
+        self.schema_path = None
+
+    def _create_schema(self):
+        os.makedirs(self.levels_dir, exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=30)
+        # WAL mode is stored in the database file, so it only needs setting here
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS levels (name TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, summary TEXT NOT NULL)')
+            # Bumped whenever a summary changes; ETags are derived from it
+            conn.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)')
+            # Seeded from the clock so a recreated index never reissues an old ETag
+            conn.execute('INSERT OR IGNORE INTO generation VALUES (0, ?)', (time.time_ns(),))
+        conn.close()
+
+    def _connect(self):
+        """
+        A plain connection; a connection per call keeps the index safe to use across
+        threads and forked workers. The schema is created on first use rather than at
+        import, when relative paths may not resolve against the final working directory.
+        """
+        index_path = os.path.abspath(self.index_path)
+        if self.schema_path != index_path:
+            self._create_schema()
+            self.schema_path = index_path
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def _metadata_mtime(self, name):
+        try:
+            return os.stat(os.path.join(self.levels_dir, name, 'metadata.json')).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def update(self, name, metadata):
+        """Record a level's summary after its metadata.json was written."""
+        summary = json.dumps(level_summary(metadata))
+        conn = self._connect()
+        with conn:
+            row = conn.execute('SELECT summary FROM levels WHERE name = ?', (name,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO levels VALUES (?, ?, ?)', (name, self._metadata_mtime(name), summary))
+            if row is None or row[0] != summary:
+                conn.execute('UPDATE generation SET value = value + 1')
+        conn.close()
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+
+        conn = self._connect()
+        known = {name: (mtime, summary) for name, mtime, summary in conn.execute('SELECT name, mtime_ns, summary FROM levels')}
+        present = set()
+        changed = []
+        for entry in os.scandir(self.levels_dir):
+            if not entry.is_dir():
+                continue
+            present.add(entry.name)
+            mtime = self._metadata_mtime(entry.name)
+            if entry.name in known and known[entry.name][0] == mtime:
+                continue
+            summary = {'level_name': entry.name}
+            if mtime:
+                try:
+                    with open(os.path.join(entry.path, 'metadata.json'), 'r') as f:
+                        summary = level_summary(json.load(f))
+                except (OSError, ValueError):
+                    continue
+            changed.append((entry.name, mtime, json.dumps(summary)))
+        removed = [(name,) for name in known if name not in present]
+        # A touched metadata.json with the same summary only needs its mtime recorded
+        modified = removed or any(name not in known or known[name][1] != summary for name, _, summary in changed)
+        if changed or removed:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO levels VALUES (?, ?, ?)', changed)
+                conn.executemany('DELETE FROM levels WHERE name = ?', removed)
+                if modified:
+                    conn.execute('UPDATE generation SET value = value + 1')
+        conn.close()
+        if changed or removed:
+            print("Level index refreshed: {} changed, {} removed".format(len(changed), len(removed)))
+
+    def version(self):
+        """Changes whenever any level is added, updated or removed."""
+        conn = self._connect()
+        generation = conn.execute('SELECT value FROM generation').fetchone()[0]
+        conn.close()
+        return generation
+
+    def etag(self, offset=0, limit=None):
+        return hashlib.sha256('{}:{}:{}'.format(self.version(), offset, limit).encode()).hexdigest()[:32]
+
+    def page(self, offset=0, limit=None):
+        """Return (summaries ordered by name, total level count)."""
+        conn = self._connect()
+        total = conn.execute('SELECT COUNT(*) FROM levels').fetchone()[0]
+        rows = conn.execute('SELECT summary FROM levels ORDER BY name LIMIT ? OFFSET ?',
+                            (-1 if limit is None else limit, offset)).fetchall()
+        conn.close()
+        return [json.loads(summary) for (summary,) in rows], total
@@ -1,15 +1,16 @@
 import geopandas as gpd
-from shapely.geometry import Point, box
 import rasterio
-from rasterio.transform import from_origin, Affine
-from rasterio.features import rasterize
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.windows import Window
+from rasterio.transform import from_origin, Affine, array_bounds
+from rasterio.warp import reproject, Resampling
 import numpy as np
-import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+import math
+import os
 from util import get_elapsed_time
+from profiling import stage
+from soil_store import SoilStore, LazySoilStore, load_soil_attributes
+from lazy_layers import TileCache, LazyLayer, MAX_CACHED_TILES
+from shared_layers import SharedLayer
 
 SOILDB_PATH = '../data/SSURGODB.gpkg' 
 DEM_PATH = '../data/merged_dem.tif'
@@ -21,107 +22,236 @@ FLOWLINES_LAYER = 'nhdflowline_or'
 WATERBODIES_LAYER = 'nhdwaterbody_or' 
 EROMMA_LAYER = 'nhdpluseromma_or'
 
+# Threads GDAL uses to resample the DEM window onto the level grid
+DEM_THREADS = int(os.environ.get('HABITAT_DEM_THREADS', os.cpu_count() or 1))
+# 'auto' memory-maps uncompressed strip DEMs, 'off' always reads through GDAL
+DEM_MMAP = os.environ.get('HABITAT_DEM_MMAP', 'auto')
+
+
+def dem_read_window(src, bounds):
+    """
+    Window of the DEM covering bounds, padded by one pixel for bilinear resampling
+    and widened to whole internal blocks so GDAL never decodes a block twice.
+    """
+    window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+    block_height, block_width = src.block_shapes[0]
+    row_start = max(int(math.floor(window.row_off)) - 1, 0) // block_height * block_height
+    col_start = max(int(math.floor(window.col_off)) - 1, 0) // block_width * block_width
+    row_stop = min(-(-(int(math.ceil(window.row_off + window.height)) + 1) // block_height) * block_height, src.height)
+    col_stop = min(-(-(int(math.ceil(window.col_off + window.width)) + 1) // block_width) * block_width, src.width)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def dem_decimation(src, resolution):
+    # Whole-pixel factor by which the DEM is finer than the target grid; reading at that
+    # factor keeps at least one source pixel per target pixel
+    return max(int(resolution / max(abs(src.res[0]), abs(src.res[1]))), 1)
+
+def mmap_dem_band(src):
+    """
+    Memory-map band 1 of an uncompressed, strip-organized GeoTIFF whose strips are
+    stored back to back. Returns None for any other layout.
+    """
+    if DEM_MMAP == 'off' or src.driver != 'GTiff' or src.count != 1 or src.compression is not None:
+        return None
+    block_height, block_width = src.block_shapes[0]
+    if block_width != src.width:
+        return None
+    dtype = np.dtype(src.dtypes[0])
+    strip_bytes = block_height * src.width * dtype.itemsize
+    last_strip = (src.height - 1) // block_height
+    first_offset = src.get_tag_item('BLOCK_OFFSET_0_0', 'TIFF', bidx=1)
+    last_offset = src.get_tag_item('BLOCK_OFFSET_0_{}'.format(last_strip), 'TIFF', bidx=1)
+    if first_offset is None or last_offset is None or int(last_offset) != int(first_offset) + last_strip * strip_bytes:
+        return None
+    with open(src.name, 'rb') as f:
+        byte_order = '<' if f.read(2) == b'II' else '>'
+    return np.memmap(src.name, dtype=dtype.newbyteorder(byte_order), mode='r', offset=int(first_offset),
+                     shape=(src.height, src.width))
+
+def clamp_to_dem(src, bbox):
+    # Boxes reaching past the DEM edge are clamped; the uncovered part of the grid stays NaN
+    dem_bounds = src.bounds
+    clamped = [max(bbox[0], dem_bounds.left), max(bbox[1], dem_bounds.bottom),
+               min(bbox[2], dem_bounds.right), min(bbox[3], dem_bounds.top)]
+    if clamped[0] >= clamped[2] or clamped[1] >= clamped[3]:
+        raise ValueError("Bounding box is out of DEM bounds.")
+    return clamped
+
+def read_dem_window(src, window, resolution):
+    """
+    Read a DEM window for resampling to resolution. Returns the array, its transform
+    and which read path was used: 'mmap', 'decimated' (GDAL serves these from the
+    closest overview when the file has them) or 'full'.
+    """
+    band = mmap_dem_band(src)
+    if band is not None:
+        rows, cols = window.toslices()
+        return band[rows, cols], src.window_transform(window), 'mmap'
+
+    factor = dem_decimation(src, resolution)
+    if factor > 1:
+        out_shape = (max(int(window.height) // factor, 1), max(int(window.width) // factor, 1))
+        data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.average)
+        transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+        return data, transform, 'decimated'
+    return src.read(1, window=window), src.window_transform(window), 'full'
+
 class DataService:
-    def __init__(self):
+    def __init__(self, lazy=False, max_cached_tiles=MAX_CACHED_TILES, shared=False):
+        # In lazy mode vector layers are read per request from GeoPackage tiles. Shared mode
+        # reads them per request from memory-mapped files that all worker processes share.
+        self.lazy = lazy or shared
+        self.shared = shared
+        self.tile_cache = TileCache(max_cached_tiles)
+        self.flowlines_layer = self._vector_layer(WATERDB_PATH, FLOWLINES_LAYER)
+        self.waterbodies_layer = self._vector_layer(WATERDB_PATH, WATERBODIES_LAYER)
         self.spatial_gdf = None
         self.flowlines_gdf = None
         self.waterbodies_gdf = None
         self.eromma_df = None
+        self.flow_lookup = None
         self.data_loaded = False
-        self.chorizon_df = None
-        self.fragment_df = None
+        self.attributes_df = None
+        self.soil_store = None
+        # DEM pixels read once for a group of nearby levels (see prefetch_dem)
+        self.dem_window = None
 
+    def _vector_layer(self, path, layer):
+        if self.shared:
+            return SharedLayer(path, layer)
+        return LazyLayer(path, layer, self.tile_cache)
 
     def load_base_data(self):
-        # Connect to the SQLite database and load relevant tables
-        conn = sqlite3.connect(SOILDB_PATH)
-        self.component_df = pd.read_sql_query("SELECT mukey, cokey, taxorder, map_l, map_r, map_h, airtempa_l, airtempa_r, airtempa_h FROM component", conn)
-        self.chorizon_df = pd.read_sql_query("""SELECT ch.cokey, ch.om_r, ch.hzname, ch.sandtotal_r, ch.silttotal_r, ch.claytotal_r, ch.hzdept_r, ch.hzdepb_r, fr.fragvol_r FROM chorizon AS ch LEFT JOIN chfrags AS fr ON ch.chkey = fr.chkey""", conn
-        )
-        conn.close()
-        print("Load tabular soil data from database {}".format(get_elapsed_time()))
-
-        self.spatial_gdf = gpd.read_file(SOILDB_PATH, layer=SPATIAL_LAYER)
-        print("Load soil data from file {}".format(get_elapsed_time()))
-
-        self.flowlines_gdf = gpd.read_file(WATERDB_PATH, layer=FLOWLINES_LAYER)
-        self.waterbodies_gdf = gpd.read_file(WATERDB_PATH, layer=WATERBODIES_LAYER)
-        self.eromma_df = gpd.read_file(WATERDB_PATH, layer=EROMMA_LAYER)
+        # Components and horizons are collapsed to one row per map unit inside SQLite
+        with stage('soil_attributes') as record:
+            self.attributes_df = load_soil_attributes(SOILDB_PATH)
+            record['features'] = len(self.attributes_df)
+
+        if self.lazy:
+            soil_layer = self._vector_layer(SOILDB_PATH, SPATIAL_LAYER)
+            self.soil_store = LazySoilStore(soil_layer, self.attributes_df)
+            self.eromma_df = gpd.read_file(WATERDB_PATH, layer=EROMMA_LAYER, columns=['nhdplusid', 'qe'], ignore_geometry=True)
+            self.flow_lookup = self.eromma_df.drop_duplicates('nhdplusid').set_index('nhdplusid')['qe']
+            print("Load flow table from file {}".format(get_elapsed_time()))
+            self.data_loaded = True
+            return
+
+        with stage('soil_polygons') as record:
+            self.spatial_gdf = gpd.read_file(SOILDB_PATH, layer=SPATIAL_LAYER)
+            print("Load soil data from file {}".format(get_elapsed_time()))
+            self.soil_store = SoilStore(self.spatial_gdf, self.attributes_df)
+            record['features'] = len(self.spatial_gdf)
+
+        with stage('water_base') as record:
+            self.flowlines_gdf = gpd.read_file(WATERDB_PATH, layer=FLOWLINES_LAYER)
+            self.waterbodies_gdf = gpd.read_file(WATERDB_PATH, layer=WATERBODIES_LAYER)
+            self.eromma_df = gpd.read_file(WATERDB_PATH, layer=EROMMA_LAYER)
+            self.flow_lookup = self.eromma_df.drop_duplicates('nhdplusid').set_index('nhdplusid')['qe']
+            record['features'] = len(self.flowlines_gdf) + len(self.waterbodies_gdf)
         print("Load water data from file {}".format(get_elapsed_time()))
         self.data_loaded = True
 
+    def warm_up(self, bounding_boxes=()):
+        if not self.data_loaded:
+            self.load_base_data()
+        if self.shared:
+            # Exported (when stale) and mapped before any worker forks
+            for layer in (self.soil_store.soil_layer, self.flowlines_layer, self.waterbodies_layer):
+                layer.open()
+            print("Opened shared vector layers {}".format(get_elapsed_time()))
+        if self.lazy:
+            for bounding_box in bounding_boxes:
+                self.soil_store.soil_layer.read(bounding_box)
+                self.flowlines_layer.read(bounding_box)
+                self.waterbodies_layer.read(bounding_box)
+            print("Warmed up {} tiles {}".format(len(self.tile_cache.tiles), get_elapsed_time()))
+
     def load_soil_data(self, bounding_box):
-        merged_gdf = self.spatial_gdf.merge(self.component_df, on='mukey')
-        merged_gdf = merged_gdf.merge(self.chorizon_df, on='cokey')
-        bounding_box_gdf = bounding_box.to_crs(merged_gdf.crs)
-        merged_gdf = gpd.overlay(merged_gdf, bounding_box_gdf, how='intersection')
+        with stage('soil_store_query') as record:
+            merged_gdf = self.soil_store.query(bounding_box)
+            record.update(self.soil_store.last_query_stats)
         print("Soil Data Processed. {}".format(get_elapsed_time()))
         return merged_gdf
 
-    def load_dem_data(self, bounding_box, resolution):
+    def load_dem_data(self, bounding_box, resolution, num_threads=DEM_THREADS):
         with rasterio.open(DEM_PATH) as src:
             dem_crs = src.crs
-            dem_transform = src.transform
-            bbox_gdf = bounding_box.to_crs(dem_crs)
-            bbox = bbox_gdf.total_bounds   
-            dem_bounds = src.bounds
-            if (bbox[0] < dem_bounds.left or bbox[2] > dem_bounds.right or
-                bbox[1] < dem_bounds.bottom or bbox[3] > dem_bounds.top):
-                raise ValueError("Bounding box is out of DEM bounds.")
-            window = rasterio.windows.from_bounds(*bbox, transform=dem_transform)
-            dem_clip = src.read(1, window=window)
-            transform_clip = src.window_transform(window)
+            bbox = bounding_box.to_crs(dem_crs).total_bounds
+            width = int((bbox[2] - bbox[0]) / resolution)
+            height = int((bbox[3] - bbox[1]) / resolution)
 
-        print("DEM data clipped. {}".format(get_elapsed_time()))
-        width = int((bbox[2] - bbox[0]) / resolution)
-        height = int((bbox[3] - bbox[1]) / resolution)
+            # Check if dimensions are valid
+            if width <= 0 or height <= 0:
+                raise ValueError(f"Invalid target dimensions: width={width}, height={height}")
 
-        # Check if dimensions are valid
-        if width <= 0 or height <= 0:
-            raise ValueError(f"Invalid target dimensions: width={width}, height={height}")
+            window = dem_read_window(src, clamp_to_dem(src, bbox))
+            if self._prefetched_dem_covers(src.window_bounds(window), resolution):
+                dem_clip, transform_clip = self.dem_window['data'], self.dem_window['transform']
+            else:
+                with stage('dem_clip') as record:
+                    dem_clip, transform_clip, record['method'] = read_dem_window(src, window, resolution)
+                    record['pixels'] = dem_clip.size
 
-        dem_data = np.empty((height, width), dtype=np.float32)
+        print("DEM data clipped. {}".format(get_elapsed_time()))
+        dem_data = np.full((height, width), np.nan, dtype=np.float32)
         dst_transform = from_origin(bbox[0], bbox[3], resolution, resolution)
-        reproject(
-            source=dem_clip,
-            destination=dem_data,
-            src_transform=transform_clip,
-            src_crs=dem_crs,
-            dst_transform=dst_transform,
-            dst_crs=dem_crs,
-            dst_nodata=np.nan,
-            resampling=Resampling.bilinear,
-            num_threads=1
-        )
+        with stage('dem_reproject', pixels=dem_data.size, threads=num_threads):
+            reproject(
+                source=dem_clip,
+                destination=dem_data,
+                src_transform=transform_clip,
+                src_crs=dem_crs,
+                dst_transform=dst_transform,
+                dst_crs=dem_crs,
+                dst_nodata=np.nan,
+                resampling=Resampling.bilinear,
+                num_threads=num_threads
+            )
         print("DEM data reprojected. {}".format(get_elapsed_time()))
         return dem_data, dst_transform
 
-    def load_water_data(self, bounding_box):
-        
-        eromma_df = self.eromma_df[['nhdplusid', 'qe']]
-        bounding_box_gdf = bounding_box.to_crs(self.flowlines_gdf.crs)
-        
-        flowlines_gdf = gpd.overlay(self.flowlines_gdf, bounding_box_gdf, how='intersection')
-        waterbodies_gdf = gpd.overlay(self.waterbodies_gdf, bounding_box_gdf, how='intersection')
-        print("Filtered data for bounding box {}".format(get_elapsed_time()))
-
-        flowlines_gdf = flowlines_gdf.merge(eromma_df, on='nhdplusid')
-        print("Merged data {}".format(get_elapsed_time()))
-
-
-        flowlines_gdf = flowlines_gdf.to_crs(crs=3857)
-        flowlines_gdf['buffer'] = .002 #(flowlines_gdf['qe'] / 3000) * .002
-        buffered_flowlines_gdf = flowlines_gdf.copy()
-        buffered_flowlines_gdf['geometry'] = flowlines_gdf.buffer(buffered_flowlines_gdf['buffer'])
-        print("Buffered Flowlines {}".format(get_elapsed_time()))
-    
-        buffered_flowlines_gdf = buffered_flowlines_gdf.to_crs(MAIN_CRS)
-        waterbodies_gdf = waterbodies_gdf.to_crs(MAIN_CRS)
-
-    
-        # Combine the buffered flowlines with the waterbodies polygons
-        combined_gdf = gpd.GeoDataFrame(pd.concat([buffered_flowlines_gdf, waterbodies_gdf], ignore_index=True))
-        #combined_gdf = combined_gdf[combined_gdf.geometry.intersects(bounding_box)]
-        print("Combined Flowlines and Waterbodies {}".format(get_elapsed_time()))
-
-        return combined_gdf
\ No newline at end of file
+    def prefetch_dem(self, bounding_box, resolution):
+        """
+        Read the DEM under a box covering several levels once. load_dem_data then
+        resamples levels inside it from memory until release_dem() is called.
+        """
+        with rasterio.open(DEM_PATH) as src:
+            bbox = bounding_box.to_crs(src.crs).total_bounds
+            window = dem_read_window(src, clamp_to_dem(src, bbox))
+            with stage('dem_prefetch') as record:
+                data, transform, record['method'] = read_dem_window(src, window, resolution)
+                record['pixels'] = data.size
+        self.dem_window = {'data': data, 'transform': transform, 'resolution': resolution}
+        print("Prefetched {} DEM pixels {}".format(data.size, get_elapsed_time()))
+
+    def release_dem(self):
+        self.dem_window = None
+
+    def _prefetched_dem_covers(self, bounds, resolution):
+        if self.dem_window is None or self.dem_window['resolution'] != resolution:
+            return False
+        height, width = self.dem_window['data'].shape
+        left, bottom, right, top = array_bounds(height, width, self.dem_window['transform'])
+        # Within a hundredth of a pixel, to allow for rounding in the window transforms
+        tolerance = abs(self.dem_window['transform'].a) / 100
+        return (bounds[0] >= left - tolerance and bounds[1] >= bottom - tolerance and
+                bounds[2] <= right + tolerance and bounds[3] <= top + tolerance)
+
+    def _within_bounding_box(self, gdf, bounding_box):
+        candidate_idx = gdf.sindex.query(bounding_box.to_crs(gdf.crs).geometry.iloc[0], predicate='intersects')
+        return gdf.iloc[candidate_idx].to_crs(MAIN_CRS)
+
+    def load_flowlines(self, bounding_box):
+        flowlines_gdf = self.flowlines_layer.read(bounding_box) if self.lazy else self.flowlines_gdf
+        flowlines_gdf = self._within_bounding_box(flowlines_gdf, bounding_box)
+        # Flowlines without an EROM record were dropped by the old inner merge, keep that behaviour
+        flowlines_gdf = flowlines_gdf[flowlines_gdf['nhdplusid'].isin(self.flow_lookup.index)].copy()
+        flowlines_gdf['qe'] = flowlines_gdf['nhdplusid'].map(self.flow_lookup)
+        print("Filtered {} flowlines for bounding box {}".format(len(flowlines_gdf), get_elapsed_time()))
+        return flowlines_gdf
+
+    def load_waterbodies(self, bounding_box):
+        waterbodies_gdf = self.waterbodies_layer.read(bounding_box) if self.lazy else self.waterbodies_gdf
+        waterbodies_gdf = self._within_bounding_box(waterbodies_gdf, bounding_box)
+        print("Filtered {} waterbodies for bounding box {}".format(len(waterbodies_gdf), get_elapsed_time()))
+        return waterbodies_gdf
@@ -0,0 +1,165 @@
+import cProfile
+import math
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets exposed on /metrics
+STAGE_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf]
+
+_local = threading.local()
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return round(resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2, 1)
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """
+    Peak RSS since the last reset_peak_rss(). Without /proc this falls back to
+    ru_maxrss, the peak over the whole life of the process.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class LevelProfile:
+    """
+    Per-stage timings and memory readings for one level build.
+
+    Pool workers are reused across levels, so the peak RSS counter is reset when
+    the level and each of its stages start. Stage peaks are therefore their own,
+    and the level peak is the highest of them.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        # Records of the stages currently running, innermost last
+        self.open_stages = []
+        self.peak_mb = 0.0
+        reset_peak_rss()
+
+    def level_peak_rss_mb(self):
+        return max(self.peak_mb, peak_rss_mb())
+
+    def to_metadata(self):
+        return {
+            'totalSeconds': round(time.perf_counter() - self.start, 3),
+            'peakRssMb': self.level_peak_rss_mb(),
+            'stages': self.stages,
+        }
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+@contextmanager
+def profiled_level(profile_path=None):
+    """
+    Collect stage() records for everything run inside the block. If profile_path
+    is given, the block is also run under cProfile and the stats dumped there.
+    """
+    previous = current_profile()
+    if previous is not None:
+        previous.peak_mb = max(previous.peak_mb, peak_rss_mb())
+    profile = LevelProfile()
+    _local.profile = profile
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield profile
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if previous is not None:
+            previous.peak_mb = max(previous.peak_mb, profile.level_peak_rss_mb())
+        _local.profile = previous
+
+@contextmanager
+def stage(name, **info):
+    """
+    Time a pipeline stage. The yielded dict can be filled with counts (features,
+    pixels, ...) and is stored with the timing when a level profile is active.
+    """
+    record = dict(info)
+    profile = current_profile()
+    if profile is not None:
+        # The reset also hides the enclosing stage's peak so far, so keep it before resetting
+        if profile.open_stages:
+            parent = profile.open_stages[-1]
+            parent['peakRssMb'] = max(parent.get('peakRssMb', 0), peak_rss_mb())
+        profile.peak_mb = max(profile.peak_mb, peak_rss_mb())
+        profile.open_stages.append(record)
+        reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.open_stages.pop()
+            record['name'] = name
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['rssMb'] = current_rss_mb()
+            record['peakRssMb'] = max(record.get('peakRssMb', 0), peak_rss_mb())
+            profile.peak_mb = max(profile.peak_mb, record['peakRssMb'])
+            if profile.open_stages:
+                parent = profile.open_stages[-1]
+                parent['peakRssMb'] = max(parent.get('peakRssMb', 0), record['peakRssMb'])
+            profile.stages.append(record)
+
+
+class StageMetrics:
+    """Cumulative histograms of stage durations across finished builds, in Prometheus text format."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for idx, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['counts'][idx] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def observe_timings(self, timings):
+        for record in timings.get('stages', []):
+            name = record['name'] if 'layer' not in record else '{}_{}'.format(record['name'], record['layer'])
+            self.observe(name, record['seconds'])
+        self.observe('level_total', timings['totalSeconds'])
+
+    def render(self):
+        lines = ['# TYPE habitat_stage_seconds histogram']
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram['counts']):
+                    le = '+Inf' if bound == math.inf else str(bound)
+                    lines.append('habitat_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, le, count))
+                lines.append('habitat_stage_seconds_sum{{stage="{}"}} {}'.format(name, round(histogram['sum'], 4)))
+                lines.append('habitat_stage_seconds_count{{stage="{}"}} {}'.format(name, histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -1,126 +1,274 @@
-import geopandas as gpd
-from shapely.geometry import box
-from rasterio.transform import from_origin
+from rasterio.transform import from_origin, array_bounds
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.features import rasterize
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import rasterio
-from util import get_elapsed_time
+from rasterio.errors import NotGeoreferencedWarning
+import warnings
+import os
+from util import atomic_write, get_elapsed_time
+from profiling import stage
 
+TARGET_CRS = 'EPSG:32610'
+SRC_CRS = 'EPSG:4326'
+REPROJECT_THREADS = os.cpu_count() or 1
+# 'png' writes one 8-bit image per layer, 'cog' a single multi-band Cloud Optimized GeoTIFF
+OUTPUT_FORMAT_CHOICES = ['cog', 'png']
+COG_FILE_NAME = 'layers.tif'
+COG_BLOCK_SIZE = 256
 
-def normalize_raster(raster_data):
-    raster_min = np.nanmin(raster_data)
-    raster_max = np.nanmax(raster_data)
+
+def normalize_output_formats(output_formats):
+    """Check a list (or comma separated string) of output formats; return them sorted, without duplicates."""
+    if isinstance(output_formats, str):
+        output_formats = output_formats.split(',')
+    if not isinstance(output_formats, (list, tuple)) or not output_formats:
+        raise ValueError("outputFormats must be a non-empty list of {}".format(', '.join(OUTPUT_FORMAT_CHOICES)))
+    unknown = [output_format for output_format in output_formats if output_format not in OUTPUT_FORMAT_CHOICES]
+    if unknown:
+        raise ValueError("Unknown output formats {}; expected {}".format(unknown, ', '.join(OUTPUT_FORMAT_CHOICES)))
+    return sorted(set(output_formats))
+
+OUTPUT_FORMATS = normalize_output_formats(os.environ.get('HABITAT_OUTPUT_FORMATS', 'png,cog'))
+
+
+def nan_stats(raster_data, axis=None):
+    """nanmin and nanmax, NaN without a warning where there is no data at all."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmin(raster_data, axis=axis), np.nanmax(raster_data, axis=axis)
+
+def stat_value(value):
+    """A min or max for metadata.json, which has no NaN: None for a layer without data."""
+    return None if np.isnan(value) else value.item()
+
+def to_png_bytes(raster_data):
+    """Scale 0..1 data to 0..255; nodata (NaN) pixels are written as 0."""
+    return np.nan_to_num(raster_data * 255, nan=0).astype(np.uint8)
+
+def normalize_raster(raster_data, raster_min=None, raster_max=None):
+    if raster_min is None:
+        raster_min, raster_max = nan_stats(raster_data)
     print("Min: {}, Max: {}".format(raster_min, raster_max))
     if (raster_max == raster_min):
         raster_data_normalized =  raster_data
     else:
         raster_data_normalized = (raster_data - raster_min) / (raster_max - raster_min)
-    raster_data_normalized = (raster_data_normalized * 255).astype(np.uint8)
-    return raster_data_normalized, raster_min.item(), raster_max.item()
-
-def rasterize_layer(gdf, layer_name, resolution, attribute_mapping = None):
-    xmin, ymin, xmax, ymax = gdf.total_bounds
-    width = int((xmax - xmin) / resolution)
-    height = int((ymax - ymin) / resolution)
-    transform = from_origin(xmin, ymax, resolution, resolution)
-    raster_data = np.full((height, width), np.nan)
-    # Rasterize the clay content
-    for _, row in gdf.iterrows():
-        
-        value = 0
+    raster_data_normalized = to_png_bytes(raster_data_normalized)
+    return raster_data_normalized, stat_value(raster_min), stat_value(raster_max)
+
+def rasterize_layer(gdf, layer_name, resolution, attribute_mapping = None, transform = None, out_shape = None):
+    mappings = {layer_name: attribute_mapping} if attribute_mapping else None
+    raster_stack, transform = rasterize_layers(gdf, [layer_name], resolution, mappings, transform, out_shape)
+    return raster_stack[0], transform
+
+def rasterize_layers(gdf, layer_names, resolution, attribute_mappings = None, transform = None, out_shape = None, out = None):
+    """
+    Burn several attributes of a GeoDataFrame in a single pass.
+
+    Each distinct geometry is rasterized once into a feature-index raster and every
+    requested attribute is then filled by lookup, giving a (bands, height, width)
+    stack. Earlier rows win where geometries overlap unless their value for an attribute
+    is NaN, in which case the next overlapping row with a value fills that pixel. Rows
+    sharing a geometry (e.g. one map unit joined to several horizons) contribute their
+    first non-NaN value, ranked at the position of the row that supplied it.
+    Pass transform and out_shape to burn onto an existing grid such as the DEM's;
+    otherwise the grid is derived from the GeoDataFrame bounds. out may be a
+    preallocated float32 (bands, height, width) array to fill instead of a new one.
+    """
+    attribute_mappings = attribute_mappings or {}
+    if transform is None:
+        xmin, ymin, xmax, ymax = gdf.total_bounds
+        width = int((xmax - xmin) / resolution)
+        height = int((ymax - ymin) / resolution)
+        transform = from_origin(xmin, ymax, resolution, resolution)
+    else:
+        height, width = out_shape
+
+    values = pd.DataFrame(index=gdf.index)
+    for layer_name in layer_names:
         if layer_name == 'water':
-            value = 1
-        else:
-            value = row[layer_name]
-            if value is None:
-                value = np.nan
-            elif attribute_mapping:
-                value = attribute_mapping[value]    
-
-        shapes = [(row['geometry'], value)]
-
-        burned = rasterize(
-            shapes=shapes,
-            out_shape=(height, width),
-            fill=np.nan,
-            transform=transform,
-            all_touched=True,
-            dtype='float32'
-        )
-        raster_data = np.where(np.isnan(raster_data), burned, raster_data)
-    print("Successfully rasterized layer: {} {}".format(layer_name, get_elapsed_time()))
-    return raster_data, transform
-
-def print_raster(raster_data, src_transform, title, output_dir):
-    # Define the target CRS
-    target_crs = 'EPSG:32610'
-    src_crs='EPSG:4326'
-    # Create the source transform if not provided
-    #src_transform = from_origin(0, 0, 1, 1)  # Assuming a default transform
-
-    # Create a temporary file to store the reprojected raster
-    temp_raster = './tmp/temp_raster.tif'
-    
-    # Save the input numpy array to a temporary raster file
-    with rasterio.open(
-        temp_raster, 'w',
-        driver='GTiff',
-        height=raster_data.shape[0],
-        width=raster_data.shape[1],
-        count=1,
-        dtype=raster_data.dtype,
-        crs=src_crs,
-        transform=src_transform,
-    ) as dst:
-        dst.write(raster_data, 1)
-    
-    # Reproject the raster
-    reprojected_raster = './tmp/reprojected_raster.tif'
-    with rasterio.open(temp_raster) as src:
-        transform, width, height = calculate_default_transform(
-            src.crs, target_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': target_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-        
-        with rasterio.open(reprojected_raster, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=target_crs,
-                    resampling=Resampling.nearest)
-
-    # Load the reprojected raster
-    with rasterio.open(reprojected_raster) as reprojected_src:
-        reprojected_data = reprojected_src.read(1)
-        if (title != 'soil'):
-            normalized_raster, raster_min, raster_max = normalize_raster(reprojected_data)
-        else:
-            normalized_raster = (reprojected_data * 255).astype(np.uint8)
-            raster_min = np.nanmin(reprojected_data)
-            raster_max = np.nanmax(reprojected_data)
-        plt.imsave('{}/{}.png'.format(output_dir, title), normalized_raster, cmap='gray', vmin=0, vmax=255)
+            values[layer_name] = 1.0
+            continue
+        column = gdf[layer_name]
+        if layer_name in attribute_mappings:
+            column = column.map(attribute_mappings[layer_name], na_action='ignore')
+        values[layer_name] = pd.to_numeric(column, errors='coerce').astype('float32')
 
-        print("Successfully created raster: {}".format(title))
-        return raster_min, raster_max
+    # Group rows that share a geometry so each polygon is burned only once
+    geometry_keys = gdf.geometry.to_wkb()
+    geometry_ids, unique_keys = pd.factorize(geometry_keys)
+    values['geometry_id'] = geometry_ids
+    feature_values = values.groupby('geometry_id', sort=True).first()
+    row_positions = np.arange(len(gdf))
+    first_rows = pd.Series(row_positions).groupby(geometry_ids).first()
+    unique_geometries = gdf.geometry.iloc[first_rows.values]
+
+    if out is None:
+        raster_stack = np.full((len(layer_names), height, width), np.nan, dtype=np.float32)
+    else:
+        raster_stack = out
+        raster_stack.fill(np.nan)
+    if len(unique_keys) == 0 or width <= 0 or height <= 0:
+        return raster_stack, transform
+
+    # Each pixel takes the first row with a value for that attribute, so a row with a NaN
+    # attribute leaves the pixel to the rows after it. A geometry is ranked by the first of
+    # its rows with a value. Bands whose geometries burn in the same order share one burn
+    # of the feature index.
+    geometries = list(unique_geometries)
+    burns = {}
+    for band, layer_name in enumerate(layer_names):
+        valid_rows = values[layer_name].notna().to_numpy()
+        supplying_rows = pd.Series(row_positions[valid_rows]).groupby(geometry_ids[valid_rows]).first()
+        if len(supplying_rows) == 0:
+            continue
+        ordered_ids = supplying_rows.sort_values(kind='stable').index.to_numpy()
+        key = ordered_ids.tobytes()
+        if key not in burns:
+            # rasterize() lets later shapes overwrite earlier ones, so burn in reverse to keep the first
+            shapes = [(geometries[idx], idx) for idx in ordered_ids[::-1]]
+            feature_index = rasterize(
+                shapes=shapes,
+                out_shape=(height, width),
+                fill=-1,
+                transform=transform,
+                all_touched=True,
+                dtype='int32'
+            )
+            covered = feature_index >= 0
+            burns[key] = (covered, feature_index[covered])
+        covered, covered_index = burns[key]
+        lookup = feature_values[layer_name].to_numpy(dtype=np.float32)
+        raster_stack[band][covered] = lookup[covered_index]
+    print("Successfully rasterized layers: {} {}".format(', '.join(layer_names), get_elapsed_time()))
+    return raster_stack, transform
+
+def target_grid(src_transform, shape):
+    """Compute the EPSG:32610 output grid for a level once so every layer can share it."""
+    height, width = shape
+    bounds = array_bounds(height, width, src_transform)
+    dst_transform, dst_width, dst_height = calculate_default_transform(
+        SRC_CRS, TARGET_CRS, width, height, *bounds)
+    return dst_transform, dst_width, dst_height
+
+def reproject_raster(raster_data, src_transform, grid):
+    """Warp a float layer onto grid; pixels outside the source footprint are NaN."""
+    dst_transform, dst_width, dst_height = grid
+    reprojected_data = np.full((dst_height, dst_width), np.nan, dtype=raster_data.dtype)
+    reproject(
+        source=raster_data,
+        destination=reprojected_data,
+        src_transform=src_transform,
+        src_crs=SRC_CRS,
+        src_nodata=np.nan,
+        dst_transform=dst_transform,
+        dst_crs=TARGET_CRS,
+        dst_nodata=np.nan,
+        resampling=Resampling.nearest)
+    return reprojected_data
+
+def write_png(path, image):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path, 'w', driver='PNG', height=image.shape[0], width=image.shape[1],
+                           count=1, dtype='uint8') as dst:
+            dst.write(image, 1)
+
+def write_cog(path, raster_stack, grid, titles):
+    """
+    Write the reprojected stack, with its true values, as one internally tiled,
+    deflate-compressed COG with overviews so clients can range-read single tiles.
+    """
+    dst_transform, dst_width, dst_height = grid
+    with atomic_write(path, None) as temp_path:
+        with rasterio.open(temp_path, 'w', driver='COG', height=dst_height, width=dst_width,
+                           count=raster_stack.shape[0], dtype=raster_stack.dtype, crs=TARGET_CRS,
+                           transform=dst_transform, nodata=np.nan, compress='deflate',
+                           blocksize=COG_BLOCK_SIZE, overview_resampling='average') as dst:
+            dst.write(raster_stack)
+            dst.descriptions = tuple(titles)
+
+def update_cog(path, raster_stack, grid, titles, cog_titles):
+    """Rewrite the COG at path with the bands named in titles replaced by raster_stack."""
+    dst_transform, dst_width, dst_height = grid
+    with rasterio.open(path) as src:
+        if src.descriptions != tuple(cog_titles) or (src.height, src.width) != (dst_height, dst_width):
+            raise ValueError("{} does not match the level grid and layers".format(path))
+        full_stack = src.read()
+    for band, title in enumerate(titles):
+        full_stack[cog_titles.index(title)] = raster_stack[band]
+    write_cog(path, full_stack, grid, cog_titles)
 
-# Example normalize_raster function
-    # Load the reprojected raster
-    with rasterio.open(reprojected_raster) as reprojected_src:
-        normalized_raster, raster_min, raster_max = normalize_raster(reprojected_src.read(1))
+def print_raster_stack(raster_stack, src_transform, titles, output_dir, grid=None, num_threads=REPROJECT_THREADS,
+                       output_formats=OUTPUT_FORMATS, arena=None, cog_titles=None):
+    """
+    Reproject a (bands, height, width) stack of layers sharing one grid with a single
+    multi-threaded warp and write it out in each of output_formats. Returns {title: (min, max)}.
 
-        plt.imsave('{}/{}.png'.format(output_dir, title), normalized_raster, cmap='gray', vmin=0, vmax=255)
+    Pixels outside the warped footprint are NaN, the COG's nodata, and stay out of
+    the stats; the PNGs write them as 0.
 
+    When cog_titles lists more layers than titles, only those bands of the existing
+    COG are replaced.
+    """
+    if grid is None:
+        grid = target_grid(src_transform, raster_stack.shape[1:])
+    dst_transform, dst_width, dst_height = grid
+    if arena is None:
+        reprojected_stack = np.empty((raster_stack.shape[0], dst_height, dst_width), dtype=raster_stack.dtype)
+    else:
+        reprojected_stack = arena.get('reprojected', (raster_stack.shape[0], dst_height, dst_width), raster_stack.dtype)
+    reprojected_stack.fill(np.nan)
+    with stage('reproject_stack', bands=raster_stack.shape[0], pixels=reprojected_stack.size):
+        reproject(
+            source=raster_stack,
+            destination=reprojected_stack,
+            src_transform=src_transform,
+            src_crs=SRC_CRS,
+            src_nodata=np.nan,
+            dst_transform=dst_transform,
+            dst_crs=TARGET_CRS,
+            dst_nodata=np.nan,
+            resampling=Resampling.nearest,
+            num_threads=num_threads)
+    print("Reprojected {} layers {}".format(len(titles), get_elapsed_time()))
+
+    band_min, band_max = nan_stats(reprojected_stack, axis=(1, 2))
+    stats = {}
+    for band, title in enumerate(titles):
+        stats[title] = (stat_value(band_min[band]), stat_value(band_max[band]))
+        if 'png' not in output_formats:
+            continue
+        with stage('print_raster', layer=title):
+            if (title != 'soil'):
+                normalized_raster, _, _ = normalize_raster(reprojected_stack[band], band_min[band], band_max[band])
+            else:
+                normalized_raster = to_png_bytes(reprojected_stack[band])
+            write_png('{}/{}.png'.format(output_dir, title), normalized_raster)
         print("Successfully created raster: {}".format(title))
-        return raster_min, raster_max
+
+    if 'cog' in output_formats:
+        with stage('write_cog', bands=len(titles), pixels=reprojected_stack.size):
+            if cog_titles is None or list(cog_titles) == list(titles):
+                write_cog(os.path.join(output_dir, COG_FILE_NAME), reprojected_stack, grid, titles)
+            else:
+                update_cog(os.path.join(output_dir, COG_FILE_NAME), reprojected_stack, grid, titles, cog_titles)
+        print("Successfully created COG: {}".format(COG_FILE_NAME))
+    return stats
+
+def print_raster(raster_data, src_transform, title, output_dir, grid=None):
+    if grid is None:
+        grid = target_grid(src_transform, raster_data.shape)
+    reprojected_data = reproject_raster(raster_data, src_transform, grid)
+
+    if (title != 'soil'):
+        normalized_raster, raster_min, raster_max = normalize_raster(reprojected_data)
+    else:
+        normalized_raster = to_png_bytes(reprojected_data)
+        raster_min, raster_max = (stat_value(value) for value in nan_stats(reprojected_data))
+    write_png('{}/{}.png'.format(output_dir, title), normalized_raster)
+
+    print("Successfully created raster: {}".format(title))
+    return raster_min, raster_max
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import geopandas as gpd
+import numpy as np
+from load_data import SOILDB_PATH, DEM_PATH, WATERDB_PATH
+from weather import WEATHER_PATH
+from soil_store import SOIL_AGGREGATION
+from util import atomic_write
+
+CACHE_DIR = '../cache'
+CONSTANTS_PATH = '../constants.json'
+# Bounds of the cached vector entries, so lookups need not open every entry
+VECTOR_INDEX_FILE = '.vectors.json'
+LEVEL_OUTPUT_EXTENSIONS = ('.png', '.tif')
+SOURCE_PATHS = [SOILDB_PATH, DEM_PATH, WATERDB_PATH, WEATHER_PATH, CONSTANTS_PATH]
+MAX_CACHE_BYTES = int(os.environ.get('HABITAT_CACHE_BYTES', 2 * 1024 ** 3))
+
+
+def source_versions(paths=SOURCE_PATHS):
+    versions = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            versions.append([path, stat.st_size, stat.st_mtime_ns])
+        else:
+            versions.append([path, None, None])
+        if path == SOILDB_PATH:
+            # Soil attributes are aggregated from the database, so the aggregation is part of its version
+            versions.append(['soil_aggregation', SOIL_AGGREGATION])
+    return versions
+
+def hash_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def _dir_size(path):
+    return sum(_file_size(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def _write_pickle(path, value):
+    with atomic_write(path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _read_pickle(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+class ResultCache:
+    """
+    On-disk cache of finished levels and of intermediate per-bbox artifacts.
+
+    Every key includes the size and mtime of the source data files and
+    constants.json, so re-importing data invalidates everything built from it.
+    Finished levels are keyed on bbox and resolution, water masks on their layer
+    hash. Vector artifacts (clipped soil and water) can be served from any cached
+    entry whose bbox contains the request by clipping it down; their bounds are
+    kept in a small index file. Entries are evicted least recently used first
+    once the cache grows past max_bytes.
+
+    Any pool worker may evict at any time, so an entry that disappears or is
+    unreadable while it is being read is treated as a cache miss. Concurrent
+    index updates can drop each other's additions, which also only costs misses.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _touch(self, entry_dir):
+        try:
+            os.utime(os.path.join(entry_dir, 'entry.json'))
+        except FileNotFoundError:
+            pass
+
+    def _write_entry(self, key, entry, files):
+        """Write the files into a fresh directory and move it into place in one rename."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = os.path.join(self.cache_dir, '.{}.{}.tmp'.format(key, os.getpid()))
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        for name, write in files.items():
+            write(os.path.join(temp_dir, name))
+        with open(os.path.join(temp_dir, 'entry.json'), 'w') as f:
+            json.dump(entry, f)
+        entry_dir = self._entry_dir(key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(temp_dir, entry_dir)
+        self.evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_path = os.path.join(self.cache_dir, key, 'entry.json')
+            if key.startswith('.'):
+                continue
+            try:
+                with open(entry_path, 'r') as f:
+                    entries.append((key, json.load(f), os.path.getmtime(entry_path)))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        sizes = {key: _dir_size(self._entry_dir(key)) for key, _, _ in entries}
+        total = sum(sizes.values())
+        evicted = set()
+        for key, _, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= sizes[key]
+            evicted.add(key)
+            print("Evicted cache entry {}".format(key))
+        if evicted:
+            index = self._vector_index()
+            self._write_vector_index({key: entry for key, entry in index.items() if key not in evicted})
+
+    def _vector_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, VECTOR_INDEX_FILE), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_vector_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with atomic_write(os.path.join(self.cache_dir, VECTOR_INDEX_FILE)) as f:
+            json.dump(index, f)
+
+    def level_key(self, bounds, resolution, output_formats):
+        """output_formats must be normalized (raster.normalize_output_formats) so equal requests share a key."""
+        with open(CONSTANTS_PATH) as f:
+            constants = json.load(f)
+        return hash_key('level', [round(value, 9) for value in bounds], resolution, list(output_formats), constants,
+                        source_versions())
+
+    def get_level(self, key, level_path, metadata):
+        """Copy a cached level's outputs into level_path and return its metadata merged into ours."""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'metadata.json'), 'r') as f:
+                cached_metadata = json.load(f)
+            for file_name in os.listdir(entry_dir):
+                if file_name.endswith(LEVEL_OUTPUT_EXTENSIONS):
+                    shutil.copyfile(os.path.join(entry_dir, file_name), os.path.join(level_path, file_name))
+        except (OSError, ValueError):
+            return None
+        self._touch(entry_dir)
+        for field in ['name', 'id', 'centerPoint', 'boundHeight']:
+            cached_metadata[field] = metadata[field]
+        return cached_metadata
+
+    def put_level(self, key, level_path, output_files):
+        """Cache metadata.json and output_files, the outputs of this build, from level_path."""
+        files = {}
+        for file_name in ['metadata.json'] + list(output_files):
+            files[file_name] = lambda path, file_name=file_name: shutil.copyfile(os.path.join(level_path, file_name), path)
+        self._write_entry(key, {'kind': 'level'}, files)
+
+    def get_array(self, kind, bounds, resolution):
+        entry_dir = self._entry_dir(hash_key(kind, list(bounds), resolution, source_versions()))
+        value = _read_pickle(os.path.join(entry_dir, 'artifact.pkl'))
+        if value is None:
+            return None
+        self._touch(entry_dir)
+        print("Reused cached {}".format(kind))
+        return value
+
+    def put_array(self, kind, bounds, resolution, value):
+        key = hash_key(kind, list(bounds), resolution, source_versions())
+        self._write_entry(key, {'kind': kind}, {'artifact.pkl': lambda path: _write_pickle(path, value)})
+
+    def get_vector(self, kind, bounding_box):
+        """Return a cached GeoDataFrame for kind clipped to bounding_box, if any cached bbox contains it."""
+        minx, miny, maxx, maxy = bounding_box.total_bounds
+        versions_key = hash_key(source_versions())
+        for key, entry in self._vector_index().items():
+            if entry.get('kind') != kind or entry.get('versions') != versions_key:
+                continue
+            cached_minx, cached_miny, cached_maxx, cached_maxy = entry['bounds']
+            if cached_minx <= minx and cached_miny <= miny and cached_maxx >= maxx and cached_maxy >= maxy:
+                entry_dir = self._entry_dir(key)
+                gdf = _read_pickle(os.path.join(entry_dir, 'artifact.pkl'))
+                if gdf is None:
+                    continue
+                self._touch(entry_dir)
+                print("Reused cached {} from bbox {}".format(kind, entry['bounds']))
+                if entry['bounds'] == [minx, miny, maxx, maxy]:
+                    return gdf
+                return gpd.clip(gdf, bounding_box.to_crs(gdf.crs))
+        return None
+
+    def put_vector(self, kind, bounding_box, gdf):
+        bounds = [float(value) for value in bounding_box.total_bounds]
+        versions_key = hash_key(source_versions())
+        key = hash_key(kind, bounds, versions_key)
+        entry = {'kind': kind, 'bounds': bounds, 'versions': versions_key}
+        self._write_entry(key, entry, {'artifact.pkl': lambda path: _write_pickle(path, gdf)})
+        index = self._vector_index()
+        index[key] = entry
+        self._write_vector_index(index)
+
+    def get_water_mask(self, layer_hash):
+        entry_dir = self._entry_dir(hash_key('water_mask', layer_hash))
+        try:
+            water_mask = np.load(os.path.join(entry_dir, 'mask.npy'))
+        except (OSError, ValueError):
+            return None
+        self._touch(entry_dir)
+        print("Reused cached water mask")
+        return water_mask
+
+    def put_water_mask(self, layer_hash, water_mask):
+        def write(path):
+            with atomic_write(path, 'wb') as f:
+                np.save(f, water_mask)
+        self._write_entry(hash_key('water_mask', layer_hash), {'kind': 'water_mask'}, {'mask.npy': write})
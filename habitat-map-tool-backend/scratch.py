@@ -0,0 +1,68 @@
+import os
+import numpy as np
+
+# Optional per-level ceiling; builds whose estimate exceeds it fail before allocating
+MEMORY_BUDGET_MB = float(os.environ.get('HABITAT_MEMORY_BUDGET_MB', 0)) or None
+
+# Bytes per source pixel held at the peak of a level build. The float32 layer stack
+# lives throughout. Before reprojection it is joined by, at most, one of: the loaded
+# float32 DEM it is copied from; the water stage's uint8 mask, count and inverted
+# mask, float32 depth and float64 distance transform; or, on a partial rebuild, up to
+# seven float32 soil bands rasterized apart from the stack.
+STACK_BANDS = 12
+LAYER_STACK_BYTES_PER_PIXEL = STACK_BANDS * 4
+DEM_LOAD_BYTES_PER_PIXEL = 4
+WATER_STAGE_BYTES_PER_PIXEL = 1 + 1 + 1 + 4 + 8
+SOIL_STAGE_BYTES_PER_PIXEL = 7 * 4
+SOURCE_PEAK_BYTES_PER_PIXEL = LAYER_STACK_BYTES_PER_PIXEL + max(
+    DEM_LOAD_BYTES_PER_PIXEL, WATER_STAGE_BYTES_PER_PIXEL, SOIL_STAGE_BYTES_PER_PIXEL)
+
+
+class ScratchArena:
+    """
+    Named, reusable work buffers. Stages ask for a buffer by name and get the
+    previous allocation back whenever shape and dtype still match. Buffers a later
+    stage no longer needs should be released so they do not add to its peak.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.peak_nbytes = 0
+
+    def get(self, name, shape, dtype):
+        shape = tuple(shape)
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != np.dtype(dtype):
+            self.buffers.pop(name, None)
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+            self.peak_nbytes = max(self.peak_nbytes, self.nbytes())
+        return buffer
+
+    def release(self, *names):
+        for name in names:
+            self.buffers.pop(name, None)
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+
+def estimate_level_memory_mb(pixels, reprojected_pixels=None, output_bands=STACK_BANDS):
+    """
+    Peak scratch memory of a level with pixels on the DEM grid. The reprojected grid
+    (target_grid) usually has more pixels than the source, and at that stage it is
+    held with the layer stack, plus a copy of the stale bands on a partial rebuild.
+    """
+    if reprojected_pixels is None:
+        reprojected_pixels = pixels
+    reproject_bytes = pixels * LAYER_STACK_BYTES_PER_PIXEL + reprojected_pixels * output_bands * 4
+    if output_bands < STACK_BANDS:
+        reproject_bytes += pixels * output_bands * 4
+    peak_bytes = max(pixels * SOURCE_PEAK_BYTES_PER_PIXEL, reproject_bytes)
+    return round(peak_bytes / 1024 ** 2, 1)
+
+def check_memory_budget(pixels, reprojected_pixels=None, output_bands=STACK_BANDS, budget_mb=MEMORY_BUDGET_MB):
+    estimate_mb = estimate_level_memory_mb(pixels, reprojected_pixels, output_bands)
+    if budget_mb is not None and estimate_mb > budget_mb:
+        raise ValueError("Level needs about {} MB, over the {} MB budget".format(estimate_mb, budget_mb))
+    return estimate_mb
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import shutil
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from util import get_elapsed_time
+
+SHARED_STORE_DIR = '../cache/shared'
+
+
+def _source_key(path, layer):
+    stat = os.stat(path)
+    return hashlib.sha256(json.dumps([path, layer, stat.st_size, stat.st_mtime_ns]).encode()).hexdigest()
+
+def export_layer(layer_gdf, store_path, key):
+    """
+    Write a GeoDataFrame as flat column files: geometries as one WKB buffer with
+    offsets, per-feature bounds, numeric, bool and datetime columns as typed .npy
+    arrays and other columns as integer codes plus a JSON list of categories.
+
+    Each export goes to a new directory named after key, the source version, and
+    appears there in one rename; an existing version is never rewritten, so readers
+    that have it mapped are unaffected. Older versions are removed afterwards.
+    """
+    version_path = os.path.join(store_path, key)
+    temp_path = os.path.join(store_path, '.{}.{}.tmp'.format(key, os.getpid()))
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    wkb = shapely.to_wkb(layer_gdf.geometry.values)
+    lengths = np.fromiter((len(value) for value in wkb), dtype=np.int64, count=len(wkb))
+    np.save(os.path.join(temp_path, 'offsets.npy'), np.concatenate([[0], np.cumsum(lengths)]))
+    with open(os.path.join(temp_path, 'geometry.wkb'), 'wb') as f:
+        for value in wkb:
+            f.write(value)
+    np.save(os.path.join(temp_path, 'bounds.npy'), shapely.bounds(layer_gdf.geometry.values))
+    np.save(os.path.join(temp_path, 'index.npy'), layer_gdf.index.to_numpy())
+
+    columns = {}
+    timezones = {}
+    for column in layer_gdf.columns:
+        if column == layer_gdf.geometry.name:
+            continue
+        values = layer_gdf[column]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            # Stored as UTC; the zone is reapplied on read
+            timezones[column] = str(values.dt.tz)
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        if (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values)
+                or pd.api.types.is_datetime64_dtype(values)):
+            np.save(os.path.join(temp_path, '{}.npy'.format(column)), values.to_numpy())
+            columns[column] = 'array'
+        else:
+            codes, categories = pd.factorize(values)
+            np.save(os.path.join(temp_path, '{}.codes.npy'.format(column)), codes.astype(np.int32))
+            with open(os.path.join(temp_path, '{}.categories.json'.format(column)), 'w') as f:
+                json.dump([str(category) for category in categories], f)
+            columns[column] = 'categorical'
+
+    with open(os.path.join(temp_path, 'manifest.json'), 'w') as f:
+        json.dump({'key': key, 'count': len(layer_gdf), 'crs': layer_gdf.crs.to_wkt() if layer_gdf.crs else None,
+                   'index_name': layer_gdf.index.name, 'columns': columns, 'timezones': timezones}, f)
+    try:
+        os.replace(temp_path, version_path)
+    except OSError:
+        # Another process exported the same version first
+        shutil.rmtree(temp_path, ignore_errors=True)
+    for name in os.listdir(store_path):
+        path = os.path.join(store_path, name)
+        if name == key or name.startswith('.'):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            # Files of the unversioned layout exports used to have
+            os.remove(path)
+
+
+class SharedLayer:
+    """
+    A vector layer served from memory-mapped column files instead of per-process GeoDataFrames.
+
+    The layer is exported from its GeoPackage once (and again, into a new version
+    directory, whenever the file changes) into SHARED_STORE_DIR. Every process maps
+    the same files read-only, so the pages are shared through the OS page cache
+    however many workers there are. Reads pick features
+    through an STRtree over their stored bounds, built once per process when the layer
+    is opened, and only decode the WKB of those features. read() matches
+    LazyLayer.read(), so the lazy code paths in DataService work unchanged.
+    """
+
+    def __init__(self, path, layer, store_dir=SHARED_STORE_DIR):
+        self.path = path
+        self.layer = layer
+        self.store_path = os.path.join(store_dir, layer)
+        self.arrays = None
+        self.tree = None
+
+    def _manifest(self, key):
+        manifest_path = os.path.join(self.store_path, key, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def open(self):
+        key = _source_key(self.path, self.layer)
+        if self.arrays is not None and self.manifest['key'] == key:
+            return
+        try:
+            self._map(key)
+        except FileNotFoundError:
+            # The version was replaced while it was being mapped; export or map the new one
+            self._map(_source_key(self.path, self.layer))
+
+    def _map(self, key):
+        manifest = self._manifest(key)
+        if manifest is None:
+            layer_gdf = gpd.read_file(self.path, layer=self.layer, fid_as_index=True)
+            os.makedirs(self.store_path, exist_ok=True)
+            export_layer(layer_gdf, self.store_path, key)
+            print("Exported {} features of {} to shared store {}".format(len(layer_gdf), self.layer, get_elapsed_time()))
+            manifest = self._manifest(key)
+        version_path = os.path.join(self.store_path, key)
+
+        def load(name):
+            return np.load(os.path.join(version_path, name), mmap_mode='r')
+        arrays = {
+            'offsets': load('offsets.npy'),
+            'bounds': load('bounds.npy'),
+            'index': load('index.npy'),
+            'geometry': np.memmap(os.path.join(version_path, 'geometry.wkb'), dtype=np.uint8, mode='r')
+                        if manifest['count'] else np.zeros(0, dtype=np.uint8),
+        }
+        columns = {}
+        for column, kind in manifest['columns'].items():
+            if kind == 'array':
+                columns[column] = (load('{}.npy'.format(column)), None)
+            else:
+                with open(os.path.join(version_path, '{}.categories.json'.format(column)), 'r') as f:
+                    categories = np.array(json.load(f), dtype=object)
+                columns[column] = (load('{}.codes.npy'.format(column)), categories)
+        self.manifest = manifest
+        self.arrays = arrays
+        self.columns = columns
+        self.tree = self._bounds_tree(self.arrays['bounds'])
+
+    @staticmethod
+    def _bounds_tree(bounds):
+        # Empty geometries have NaN bounds and are left out, as no box intersects them
+        boxes = np.full(len(bounds), None, dtype=object)
+        finite = np.isfinite(bounds).all(axis=1)
+        boxes[finite] = shapely.box(*np.asarray(bounds[finite]).T)
+        return shapely.STRtree(boxes)
+
+    def take(self, positions):
+        """GeoDataFrame of the features at the given positions, indexed by fid."""
+        offsets, geometry = self.arrays['offsets'], self.arrays['geometry']
+        wkb = [geometry[offsets[position]:offsets[position + 1]].tobytes() for position in positions]
+        data = {}
+        for column, (values, categories) in self.columns.items():
+            if categories is None:
+                data[column] = np.asarray(values[positions])
+                if column in self.manifest['timezones']:
+                    data[column] = pd.Series(data[column]).dt.tz_localize('UTC').dt.tz_convert(
+                        self.manifest['timezones'][column]).to_numpy()
+            else:
+                codes = np.asarray(values[positions])
+                column_values = np.empty(len(codes), dtype=object)
+                column_values[codes >= 0] = categories[codes[codes >= 0]]
+                data[column] = column_values
+        return gpd.GeoDataFrame(data, geometry=shapely.from_wkb(wkb), crs=self.manifest['crs'],
+                                index=pd.Index(np.asarray(self.arrays['index'][positions]), name=self.manifest['index_name']))
+
+    def read(self, bounding_box):
+        self.open()
+        crs = self.manifest['crs']
+        minx, miny, maxx, maxy = (bounding_box.to_crs(crs) if crs else bounding_box).total_bounds
+        # Sorted so features come back in file order
+        positions = np.sort(self.tree.query(shapely.box(minx, miny, maxx, maxy)))
+        return self.take(positions)
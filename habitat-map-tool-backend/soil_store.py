@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from util import atomic_write, get_elapsed_time
+
+SOIL_ATTRIBUTES_CACHE = '../cache/soil_attributes.pkl'
+# Horizon attributes are averaged over the top SURFACE_DEPTH_CM, weighted by how much of it each horizon covers
+SURFACE_DEPTH_CM = float(os.environ.get('HABITAT_SOIL_SURFACE_DEPTH_CM', 30))
+# Recorded with every cached artifact built from the soil attributes; bump when the query changes
+SOIL_AGGREGATION = ['dominant_component', 'surface_weighted', 'with_surface_horizons', 'real_weights', SURFACE_DEPTH_CM]
+
+# One row per mukey: the dominant component (highest comppct_r, then lowest cokey) among those
+# with horizons in the surface layer, with its horizons depth-weighted over that layer. Depths
+# are cast to REAL so integer columns are not averaged with integer division. Fragment volumes
+# are summed per horizon first.
+SOIL_ATTRIBUTES_QUERY = """
+WITH fragments AS (
+    SELECT chkey, SUM(fragvol_r) AS fragvol_r FROM chfrags GROUP BY chkey
+),
+horizons AS (
+    SELECT ch.cokey, ch.om_r, ch.sandtotal_r, ch.silttotal_r, ch.claytotal_r, fr.fragvol_r,
+           MIN(CAST(ch.hzdepb_r AS REAL), :depth) - MAX(CAST(ch.hzdept_r AS REAL), 0) AS weight
+    FROM chorizon AS ch LEFT JOIN fragments AS fr ON ch.chkey = fr.chkey
+    WHERE ch.hzdept_r < :depth AND ch.hzdepb_r > ch.hzdept_r
+),
+surface AS (
+    SELECT cokey,
+           SUM(om_r * weight) / SUM(CASE WHEN om_r IS NOT NULL THEN weight END) AS om_r,
+           SUM(sandtotal_r * weight) / SUM(CASE WHEN sandtotal_r IS NOT NULL THEN weight END) AS sandtotal_r,
+           SUM(silttotal_r * weight) / SUM(CASE WHEN silttotal_r IS NOT NULL THEN weight END) AS silttotal_r,
+           SUM(claytotal_r * weight) / SUM(CASE WHEN claytotal_r IS NOT NULL THEN weight END) AS claytotal_r,
+           SUM(fragvol_r * weight) / SUM(CASE WHEN fragvol_r IS NOT NULL THEN weight END) AS fragvol_r
+    FROM horizons GROUP BY cokey
+),
+components AS (
+    SELECT mukey, cokey, taxorder, map_r, airtempa_r,
+           ROW_NUMBER() OVER (PARTITION BY mukey ORDER BY comppct_r DESC, cokey) AS component_rank
+    FROM component
+    WHERE cokey IN (SELECT cokey FROM surface)
+)
+SELECT c.mukey, c.cokey, c.taxorder, c.map_r, c.airtempa_r,
+       s.om_r, s.sandtotal_r, s.silttotal_r, s.claytotal_r, s.fragvol_r
+FROM components AS c JOIN surface AS s ON c.cokey = s.cokey
+WHERE c.component_rank = 1
+ORDER BY c.mukey
+"""
+
+
+def _attributes_key(db_path):
+    stat = os.stat(db_path)
+    return hashlib.sha256(json.dumps([db_path, stat.st_size, stat.st_mtime_ns, SOIL_AGGREGATION]).encode()).hexdigest()
+
+def load_soil_attributes(db_path, cache_path=SOIL_ATTRIBUTES_CACHE):
+    """
+    Per-mukey soil attributes, aggregated inside SQLite by SOIL_ATTRIBUTES_QUERY. The
+    result is cached at cache_path and reused until the database or SOIL_AGGREGATION changes.
+    """
+    key = _attributes_key(db_path)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] == key:
+            print("Soil attributes read from cache {}".format(get_elapsed_time()))
+            return cached['attributes']
+
+    conn = sqlite3.connect(db_path)
+    attributes_df = pd.read_sql_query(SOIL_ATTRIBUTES_QUERY, conn, params={'depth': SURFACE_DEPTH_CM})
+    conn.close()
+    numeric_columns = ['map_r', 'airtempa_r', 'om_r', 'sandtotal_r', 'silttotal_r', 'claytotal_r', 'fragvol_r']
+    attributes_df[numeric_columns] = attributes_df[numeric_columns].astype('float64')
+    print("Aggregated soil attributes for {} map units {}".format(len(attributes_df), get_elapsed_time()))
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with atomic_write(cache_path, 'wb') as f:
+        pickle.dump({'key': key, 'attributes': attributes_df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return attributes_df
+
+
+class SoilStore:
+    """
+    Soil polygons pre-joined to their per-mukey attributes (see load_soil_attributes),
+    so each polygon carries exactly one row. Queries go through the spatial index so
+    only polygons near the bounding box are clipped.
+    """
+
+    def __init__(self, spatial_gdf, attributes_df):
+        self.attributes_df = attributes_df
+        self.gdf = spatial_gdf.merge(self.attributes_df, on='mukey')
+        self.crs = self.gdf.crs
+        # Build the STRtree up front rather than on the first request
+        self.gdf.sindex
+        self.last_query_stats = {}
+        print("Soil store built with {} polygons {}".format(len(self.gdf), get_elapsed_time()))
+
+    def query(self, bounding_box):
+        bounding_box_gdf = bounding_box.to_crs(self.crs)
+        # Sorted so overlapping polygons keep their table order for the rasterizer's first-wins rule
+        candidate_idx = np.sort(self.gdf.sindex.query(bounding_box_gdf.geometry.iloc[0], predicate='intersects'))
+        candidates_gdf = self.gdf.iloc[candidate_idx]
+        if len(candidates_gdf):
+            clipped_gdf = gpd.overlay(candidates_gdf, bounding_box_gdf, how='intersection')
+        else:
+            clipped_gdf = candidates_gdf
+
+        self.last_query_stats = {
+            'total': len(self.gdf),
+            'candidates': len(candidates_gdf),
+            'pruned': len(self.gdf) - len(candidates_gdf),
+        }
+        print("Soil query kept {candidates} of {total} polygons, pruned {pruned}".format(**self.last_query_stats))
+        return clipped_gdf
+
+
+class LazySoilStore(SoilStore):
+    """
+    SoilStore variant that never holds the whole polygon layer.
+
+    Only the per-mukey attribute table is kept in memory; polygons are read from
+    the GeoPackage tiles covering each request and joined on the fly.
+    """
+
+    def __init__(self, soil_layer, attributes_df):
+        self.soil_layer = soil_layer
+        self.attributes_df = attributes_df
+        self.last_query_stats = {}
+        print("Lazy soil store ready with {} map units {}".format(len(self.attributes_df), get_elapsed_time()))
+
+    def query(self, bounding_box):
+        # Tiles come back in tile order; sort by fid so overlaps keep table order as in SoilStore.query
+        polygons_gdf = self.soil_layer.read(bounding_box).sort_index()
+        candidates_gdf = polygons_gdf.merge(self.attributes_df, on='mukey')
+        bounding_box_gdf = bounding_box.to_crs(candidates_gdf.crs)
+        if len(candidates_gdf):
+            clipped_gdf = gpd.overlay(candidates_gdf, bounding_box_gdf, how='intersection')
+        else:
+            clipped_gdf = candidates_gdf
+
+        self.last_query_stats = {
+            'candidates': len(candidates_gdf),
+            'clipped': len(clipped_gdf),
+        }
+        print("Lazy soil query read {candidates} polygons, kept {clipped} after clipping".format(**self.last_query_stats))
+        return clipped_gdf
@@ -0,0 +1,33 @@
+"""
+Tests run against the small synthetic data set from benchmarks/synthetic_data.py.
+
+The backend resolves ../data, ../levels and ../cache relative to its working
+directory, so the session works from <root>/work of a freshly generated data set.
+"""
+import os
+import sys
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'benchmarks'))
+
+from synthetic_data import generate
+
+
+@pytest.fixture(scope='session', autouse=True)
+def synthetic_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('synthetic')
+    generate(str(root), size='small')
+    previous = os.getcwd()
+    os.chdir(os.path.join(root, 'work'))
+    yield root
+    os.chdir(previous)
+
+
+@pytest.fixture
+def level_request():
+    """A level inside the synthetic extent; give it a unique name per test."""
+    def make(name, **fields):
+        return dict({'name': name, 'centerPoint': [43.4, -124.2], 'boundHeight': 0.01}, **fields)
+    return make
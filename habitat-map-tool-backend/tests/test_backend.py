@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import backend
+import jobs
+from jobs import JobQueue
+from level_builder import build_level
+
+
+@pytest.fixture
+def client(monkeypatch):
+    job_queue = JobQueue(max_workers=2, max_pending=4)
+    monkeypatch.setattr(backend, 'job_queue', job_queue)
+    yield backend.app.test_client()
+    if job_queue.executor is not None:
+        job_queue.executor.shutdown(wait=True)
+
+
+def wait_for(client, url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(url).get_json()
+        if status['state'] in ('done', 'failed'):
+            return status
+        time.sleep(0.2)
+    raise AssertionError('{} did not finish'.format(url))
+
+
+def test_process_job_runs_to_done_and_serves_its_files(client, level_request):
+    response = client.post('/process', json=level_request('route'))
+    assert response.status_code == 202
+    job_id = response.get_json()['jobId']
+    status = wait_for(client, '/process/{}'.format(job_id))
+    assert status['state'] == 'done' and status['stage'] == 'done'
+
+    assert client.get('/levels/route').get_json()['hasBeenProcessed']
+    assert client.get('/levels/route/dem.png').status_code == 200
+    assert client.get('/process/unknown').status_code == 404
+
+
+def test_resubmitting_an_active_level_returns_its_job(client, level_request):
+    first = client.post('/process', json=level_request('route_dup')).get_json()
+    second = client.post('/process', json=level_request('route_dup')).get_json()
+    assert second == dict(first, duplicate=True)
+    wait_for(client, '/process/{}'.format(first['jobId']))
+
+
+def test_levels_are_paged_and_revalidated_with_etags(client, level_request):
+    response = client.post('/process', json=level_request('listed'))
+    wait_for(client, '/process/{}'.format(response.get_json()['jobId']))
+
+    response = client.get('/levels')
+    names = [level['name'] for level in response.get_json()]
+    assert 'listed' in names and names == sorted(names)
+    assert response.headers['X-Total-Count'] == str(len(names))
+    assert client.get('/levels', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    page = client.get('/levels?offset=1&limit=1')
+    assert [level['name'] for level in page.get_json()] == names[1:2]
+    assert page.headers['ETag'] != response.headers['ETag']
+    assert client.get('/levels?limit=-1').status_code == 400
+    assert client.get('/levels?offset=x').status_code == 400
+
+
+def test_process_rejects_unknown_output_formats(client, level_request):
+    response = client.post('/process', json=level_request('route_bad', outputFormats=['gif']))
+    assert response.status_code == 400
+
+
+def test_level_files_stay_inside_the_levels_directory(client):
+    assert client.get('/levels/../constants.json').status_code == 404
+    assert client.get('/levels/..%2F..%2Fwork/metadata.png').status_code == 404
+    assert client.get('/levels/route/metadata.json').status_code == 404
+
+
+def test_batch_builds_its_levels_and_reports_them(client, level_request):
+    levels = [level_request('batch_a'), level_request('batch_b', centerPoint=[43.41, -124.19])]
+    response = client.post('/process/batch', json={'levels': levels})
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body['levels'] == 2 and body['groups'] == 1 and body['duplicates'] == {}
+
+    status = wait_for(client, '/process/batch/{}'.format(body['batchId']))
+    assert status['done'] == 2 and status['failed'] == 0
+    assert [row['name'] for row in status['results']] == ['batch_a', 'batch_b']
+    assert client.get('/process/batch/unknown').status_code == 404
+
+
+def test_batch_shares_dedup_and_limits_with_single_jobs(client, level_request, monkeypatch):
+    # Builds run on threads that wait for release, so every job stays active until then
+    release = threading.Event()
+    monkeypatch.setattr(jobs, 'build_level', lambda data, metadata: release.wait() and metadata)
+    monkeypatch.setattr(jobs, 'build_group', lambda group: release.wait() and [
+        {'name': entry['name'], 'state': 'done'} for entry in group['entries']])
+    backend.job_queue.executor = ThreadPoolExecutor(max_workers=2)
+
+    job = client.post('/process', json=level_request('shared_a')).get_json()
+    levels = [level_request('shared_a'), level_request('shared_b', centerPoint=[43.41, -124.19])]
+    body = client.post('/process/batch', json={'levels': levels}).get_json()
+    assert body['duplicates'] == {'shared_a': job['jobId']}
+
+    # Batch levels have jobs of their own, so single submissions see them as active
+    again = client.post('/process', json=level_request('shared_b')).get_json()
+    assert again['duplicate']
+    assert client.get('/process/{}'.format(again['jobId'])).get_json()['batchId'] == body['batchId']
+
+    # Two levels are active; three more do not fit in max_pending
+    crowd = [level_request('crowd_{}'.format(index)) for index in range(3)]
+    assert client.post('/process/batch', json={'levels': crowd}).status_code == 503
+
+    release.set()
+    status = wait_for(client, '/process/batch/{}'.format(body['batchId']))
+    assert [row['name'] for row in status['results']] == ['shared_b']
+    assert status['duplicates'] == {'shared_a': job['jobId']}
+    assert wait_for(client, '/process/{}'.format(again['jobId']))['state'] == 'done'
+
+
+def test_batch_rejects_invalid_entries(client, level_request):
+    assert client.post('/process/batch', json={'levels': []}).status_code == 400
+    assert client.post('/process/batch', json=[level_request('same'), level_request('same')]).status_code == 400
+    assert client.post('/process/batch', json=[{'name': 'incomplete'}]).status_code == 400
+
+
+def die(data, metadata):
+    # Stands in for a worker killed mid-build, e.g. by the OOM killer
+    os._exit(1)
+
+
+def test_a_dead_worker_fails_its_level_and_the_pool_is_replaced(client, level_request, monkeypatch):
+    monkeypatch.setattr(jobs, 'build_level', die)
+    dead = client.post('/process', json=level_request('dead_worker')).get_json()
+    status = wait_for(client, '/process/{}'.format(dead['jobId']))
+    assert status['state'] == 'failed'
+    assert status['stage'] == 'failed'
+
+    monkeypatch.setattr(jobs, 'build_level', build_level)
+    response = client.post('/process', json=level_request('after_dead_worker'))
+    assert response.status_code == 202
+    assert wait_for(client, '/process/{}'.format(response.get_json()['jobId']))['state'] == 'done'
@@ -0,0 +1,65 @@
+import json
+import numpy as np
+import geopandas as gpd
+from rasterio.transform import from_origin
+from shapely.geometry import box
+import base_rasters
+from base_rasters import RESOLUTION, SOIL_LAYERS, build_base_rasters, read_soil_window, read_water_window
+from load_data import DataService, MAIN_CRS
+from raster import rasterize_layers
+from result_cache import CONSTANTS_PATH
+from water_mask import rasterize_water
+
+BOUNDS = [-124.25, 43.35, -124.15, 43.45]
+
+
+def build(tmp_path, monkeypatch):
+    monkeypatch.setattr(base_rasters, 'BASE_RASTER_DIR', str(tmp_path))
+    monkeypatch.setattr(base_rasters, 'SOIL_RASTER_PATH', str(tmp_path / 'soil.tif'))
+    monkeypatch.setattr(base_rasters, 'WATER_RASTER_PATH', str(tmp_path / 'water.tif'))
+    with open(CONSTANTS_PATH) as f:
+        constants = json.load(f)['constants']
+    data_service = DataService()
+    # Small blocks so the level window below spans several of them
+    build_base_rasters(data_service, constants, BOUNDS, block_size=256)
+    return data_service, constants
+
+
+def test_windows_match_rasterizing_the_level_directly(tmp_path, monkeypatch):
+    assert not base_rasters.base_rasters_available()
+    data_service, constants = build(tmp_path, monkeypatch)
+    assert base_rasters.base_rasters_available()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['soil.tif', 'water.tif']
+
+    # A level grid aligned with the base grid, so nearest resampling picks the same pixels
+    transform = from_origin(BOUNDS[0] + 200 * RESOLUTION, BOUNDS[3] - 150 * RESOLUTION, RESOLUTION, RESOLUTION)
+    shape = (300, 320)
+    height, width = shape
+    level_bounds = [transform.c, transform.f - height * RESOLUTION, transform.c + width * RESOLUTION, transform.f]
+    bounding_box = gpd.GeoDataFrame({'geometry': [box(*level_bounds)]}, crs=MAIN_CRS)
+
+    expected_soil, _ = rasterize_layers(data_service.load_soil_data(bounding_box), SOIL_LAYERS, RESOLUTION,
+                                        {'taxorder': constants['soil_type_mapping']}, transform, shape)
+    assert np.isfinite(expected_soil).any()
+    np.testing.assert_array_equal(read_soil_window(transform, shape), expected_soil)
+    expected_water = rasterize_water(data_service.load_flowlines(bounding_box),
+                                     data_service.load_waterbodies(bounding_box), transform, shape)
+    assert expected_water.any()
+    np.testing.assert_array_equal(read_water_window(transform, shape), expected_water)
+
+
+def test_rasters_from_other_sources_are_not_used(tmp_path, monkeypatch):
+    build(tmp_path, monkeypatch)
+    assert base_rasters.base_rasters_available()
+    # Standing in for a changed source file: the stored source hash no longer matches
+    monkeypatch.setattr(base_rasters, 'BASE_SOURCE_PATHS', base_rasters.BASE_SOURCE_PATHS[:-1])
+    assert not base_rasters.base_rasters_available()
+
+
+def test_window_past_the_base_extent_is_filled(tmp_path, monkeypatch):
+    build(tmp_path, monkeypatch)
+    transform = from_origin(BOUNDS[2] - 10 * RESOLUTION, BOUNDS[3], RESOLUTION, RESOLUTION)
+    soil = read_soil_window(transform, (20, 20))
+    water = read_water_window(transform, (20, 20))
+    assert np.isnan(soil[:, :, 10:]).all()
+    assert not water[:, 10:].any()
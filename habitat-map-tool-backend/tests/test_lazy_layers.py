@@ -0,0 +1,51 @@
+import geopandas as gpd
+from shapely.geometry import box
+from lazy_layers import LazyLayer, TileCache
+from load_data import DataService, SOILDB_PATH, SPATIAL_LAYER
+
+# Spans the 0.25 degree tile edge at -124.25
+STRADDLING = [-124.3, 43.38, -124.2, 43.42]
+
+
+def bounding_box(bounds):
+    return gpd.GeoDataFrame({'geometry': [box(*bounds)]}, crs='EPSG:4326')
+
+
+def test_tile_cache_evicts_least_recently_used():
+    cache = TileCache(max_tiles=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_read_matches_a_direct_bbox_read_without_duplicates():
+    layer = LazyLayer(SOILDB_PATH, SPATIAL_LAYER, TileCache())
+    assert len(layer.tile_keys(bounding_box(STRADDLING))) == 2
+    lazy = layer.read(bounding_box(STRADDLING))
+    direct = gpd.read_file(SOILDB_PATH, layer=SPATIAL_LAYER, bbox=tuple(STRADDLING), fid_as_index=True)
+    assert lazy.index.is_unique
+    assert set(direct.index) <= set(lazy.index)
+
+
+def test_tiles_are_read_once_and_reused():
+    cache = TileCache()
+    layer = LazyLayer(SOILDB_PATH, SPATIAL_LAYER, cache)
+    layer.read(bounding_box(STRADDLING))
+    misses = cache.misses
+    layer.read(bounding_box([-124.28, 43.39, -124.22, 43.41]))
+    assert cache.misses == misses
+    assert cache.hits == 2
+
+
+def test_lazy_data_service_matches_eager():
+    inside = bounding_box([-124.22, 43.38, -124.18, 43.42])
+    eager = DataService()
+    eager.load_base_data()
+    lazy = DataService(lazy=True)
+    lazy.load_base_data()
+    assert sorted(lazy.load_soil_data(inside)['mukey']) == sorted(eager.load_soil_data(inside)['mukey'])
+    assert len(lazy.load_flowlines(inside)) == len(eager.load_flowlines(inside))
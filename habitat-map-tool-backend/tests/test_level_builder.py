@@ -0,0 +1,75 @@
+import json
+import os
+import rasterio
+import level_builder
+from layer_graph import level_inputs, node_hashes, required_nodes, stale_nodes
+from level_builder import LEVEL_RESOLUTION, LEVELS_DIR, LAYER_TITLES, build_level, level_bounds, load_constants
+from raster import COG_FILE_NAME
+from result_cache import ResultCache
+
+
+def hashes_for(data, constants=None):
+    return node_hashes(level_inputs(level_bounds(data), LEVEL_RESOLUTION, constants or load_constants()))
+
+
+def test_soil_mapping_change_only_marks_the_soil_layer_stale(level_request):
+    data = level_request('graph')
+    constants = dict(load_constants())
+    previous = hashes_for(data, constants)
+    constants['soil_type_mapping'] = dict(constants['soil_type_mapping'], Alfisols=0.123)
+    assert stale_nodes(hashes_for(data, constants), previous) == {'soil'}
+
+
+def test_new_bounds_mark_everything_stale_and_missing_outputs_are_added(level_request):
+    previous = hashes_for(level_request('graph'))
+    assert stale_nodes(hashes_for(level_request('graph', boundHeight=0.02)), previous) == set(previous)
+    assert stale_nodes(previous, previous) == set()
+    assert stale_nodes(previous, previous, missing={'clay'}) == {'clay'}
+
+
+def test_water_layers_require_the_dem_and_water_mask():
+    assert required_nodes(['flood']) == {'flood', 'dem', 'water_mask'}
+    assert required_nodes(['clay']) == {'clay'}
+
+
+def test_refresh_rebuilds_only_missing_outputs(level_request, monkeypatch, tmp_path):
+    # A result cache that keeps nothing, so the refreshes are not served whole from it
+    monkeypatch.setattr(level_builder, 'result_cache', ResultCache(str(tmp_path), max_bytes=0))
+    data = level_request('refresh', outputFormats=['png'])
+    metadata = build_level(data)
+    assert sorted(metadata['rebuiltLayers']) == sorted(LAYER_TITLES + ['weather'])
+
+    os.remove(os.path.join(LEVELS_DIR, 'refresh', 'clay.png'))
+    metadata = build_level(dict(data, refresh=True))
+    assert metadata['rebuiltLayers'] == ['clay']
+    metadata = build_level(dict(data, refresh=True))
+    assert metadata['rebuiltLayers'] == []
+
+
+def test_png_only_refresh_removes_the_stale_cog(level_request):
+    level_path = os.path.join(LEVELS_DIR, 'formats')
+    metadata = build_level(level_request('formats', outputFormats=['png', 'cog']))
+    assert metadata['cog']['bands'] == LAYER_TITLES
+    with rasterio.open(os.path.join(level_path, COG_FILE_NAME)) as src:
+        assert src.count == len(LAYER_TITLES)
+
+    metadata = build_level(level_request('formats', outputFormats=['png'], refresh=True))
+    assert 'cog' not in metadata
+    assert not os.path.exists(os.path.join(level_path, COG_FILE_NAME))
+    with open(os.path.join(level_path, 'metadata.json')) as f:
+        assert 'cog' not in json.load(f)
+
+    build_level(level_request('formats', outputFormats=['cog'], refresh=True))
+    assert os.path.exists(os.path.join(level_path, COG_FILE_NAME))
+    assert not os.path.exists(os.path.join(level_path, 'dem.png'))
+
+
+def test_memory_estimate_covers_the_scratch_peak(level_request, monkeypatch, tmp_path):
+    monkeypatch.setattr(level_builder, 'result_cache', ResultCache(str(tmp_path), max_bytes=0))
+    data = level_request('memory', boundHeight=0.02)
+    memory = build_level(data)['memory']
+    assert memory['scratchMb'] <= memory['budgetMb']
+
+    os.remove(os.path.join(LEVELS_DIR, 'memory', 'clay.png'))
+    memory = build_level(dict(data, refresh=True))['memory']
+    assert memory['scratchMb'] <= memory['budgetMb']
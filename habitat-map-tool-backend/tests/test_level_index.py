@@ -0,0 +1,46 @@
+import json
+import os
+from level_index import LevelIndex
+
+
+def write_level(levels_dir, name, **fields):
+    os.makedirs(str(levels_dir / name), exist_ok=True)
+    metadata = dict({'name': name, 'id': name, 'stage': 'done', 'tempData': [1, 2, 3]}, **fields)
+    (levels_dir / name / 'metadata.json').write_text(json.dumps(metadata))
+    return metadata
+
+
+def test_generation_changes_only_with_the_summaries(tmp_path):
+    index = LevelIndex(str(tmp_path))
+    metadata = write_level(tmp_path, 'a')
+    index.update('a', metadata)
+    version = index.version()
+
+    # Fields outside the summary, and rewriting the same summary, leave ETags valid
+    index.update('a', dict(metadata, tempData=[4]))
+    assert index.version() == version
+    index.update('a', dict(metadata, stage='water'))
+    assert index.version() != version
+
+    version = index.version()
+    write_level(tmp_path, 'a', stage='water', tempData=[5])
+    index.refresh(force=True)
+    assert index.version() == version
+
+
+def test_refresh_picks_up_added_and_removed_levels_and_pages_by_name(tmp_path):
+    index = LevelIndex(str(tmp_path))
+    for name in ['c', 'a', 'b']:
+        write_level(tmp_path, name)
+    index.refresh(force=True)
+    levels, total = index.page(offset=1, limit=1)
+    assert total == 3 and [level['name'] for level in levels] == ['b']
+    assert 'tempData' not in levels[0]
+    assert index.etag(0, 1) != index.etag(1, 1)
+
+    etag = index.etag()
+    (tmp_path / 'c' / 'metadata.json').unlink()
+    (tmp_path / 'c').rmdir()
+    index.refresh(force=True)
+    assert index.etag() != etag
+    assert [level['name'] for level in index.page()[0]] == ['a', 'b']
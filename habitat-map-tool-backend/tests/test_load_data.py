@@ -0,0 +1,47 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import box
+from load_data import DataService
+
+RESOLUTION = 15 / 111000
+# The synthetic DEM covers -124.45..-123.95 by 43.15..43.65
+INSIDE = [-124.22, 43.38, -124.18, 43.42]
+
+
+def bounding_box(bounds):
+    return gpd.GeoDataFrame({'geometry': [box(*bounds)]}, crs='EPSG:4326')
+
+
+def test_dem_box_past_the_edge_is_clamped_and_padded_with_nan():
+    data_service = DataService()
+    dem, transform = data_service.load_dem_data(bounding_box([-124.5, 43.38, -124.4, 43.42]), RESOLUTION)
+    columns = np.isnan(dem).all(axis=0)
+    # West of -124.45 there is no DEM; east of it every column has values
+    edge = int(round((-124.45 - transform.c) / RESOLUTION))
+    assert columns[:edge - 1].all()
+    assert not columns[edge + 1:].any()
+
+
+def test_dem_box_outside_the_dem_is_rejected():
+    with pytest.raises(ValueError):
+        DataService().load_dem_data(bounding_box([-125.5, 43.38, -125.4, 43.42]), RESOLUTION)
+
+
+def test_prefetched_dem_is_used_for_levels_inside_it():
+    data_service = DataService()
+    direct, direct_transform = data_service.load_dem_data(bounding_box(INSIDE), RESOLUTION)
+    data_service.prefetch_dem(bounding_box([-124.3, 43.3, -124.1, 43.5]), RESOLUTION)
+    shared, shared_transform = data_service.load_dem_data(bounding_box(INSIDE), RESOLUTION)
+    data_service.release_dem()
+    assert shared_transform == direct_transform
+    np.testing.assert_allclose(shared, direct, rtol=1e-6)
+
+
+def test_soil_data_has_the_dominant_component_per_polygon():
+    data_service = DataService()
+    data_service.load_base_data()
+    soils = data_service.load_soil_data(bounding_box(INSIDE))
+    assert len(soils)
+    assert {'mukey', 'taxorder', 'claytotal_r', 'fragvol_r'} <= set(soils.columns)
+    assert soils.index.is_unique
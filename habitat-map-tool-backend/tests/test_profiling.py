@@ -0,0 +1,49 @@
+import numpy as np
+from profiling import StageMetrics, profiled_level, stage
+
+
+def test_stages_are_recorded_only_inside_a_level_profile():
+    with stage('outside') as record:
+        record['features'] = 1
+    with profiled_level() as profile:
+        with stage('load', layer='clay') as record:
+            record['features'] = 3
+            with stage('inner', pixels=10):
+                buffer = np.ones(4 * 1024 ** 2)
+            del buffer
+    assert [record['name'] for record in profile.stages] == ['inner', 'load']
+    inner, load = profile.stages
+    assert inner['pixels'] == 10 and load['features'] == 3 and load['layer'] == 'clay'
+    # The enclosing stage's peak covers its children
+    assert load['peakRssMb'] >= inner['peakRssMb']
+    timings = profile.to_metadata()
+    assert timings['peakRssMb'] >= load['peakRssMb']
+    assert load['seconds'] >= inner['seconds'] >= 0 and timings['totalSeconds'] >= 0
+
+
+def test_nested_level_profiles_restore_the_outer_one():
+    with profiled_level() as outer:
+        with profiled_level() as inner:
+            with stage('inner_level'):
+                pass
+        with stage('outer_level'):
+            pass
+    assert [record['name'] for record in inner.stages] == ['inner_level']
+    assert [record['name'] for record in outer.stages] == ['outer_level']
+
+
+def test_stage_metrics_render_cumulative_buckets():
+    metrics = StageMetrics(buckets=[0.1, 1, float('inf')])
+    metrics.observe_timings({'totalSeconds': 2.0, 'stages': [
+        {'name': 'load', 'seconds': 0.05},
+        {'name': 'write', 'layer': 'clay', 'seconds': 0.5},
+    ]})
+    metrics.observe('load', 0.5)
+    lines = metrics.render().splitlines()
+    assert lines[0] == '# TYPE habitat_stage_seconds histogram'
+    assert 'habitat_stage_seconds_bucket{stage="load",le="0.1"} 1' in lines
+    assert 'habitat_stage_seconds_bucket{stage="load",le="1"} 2' in lines
+    assert 'habitat_stage_seconds_bucket{stage="load",le="+Inf"} 2' in lines
+    assert 'habitat_stage_seconds_sum{stage="load"} 0.55' in lines
+    assert 'habitat_stage_seconds_count{stage="write_clay"} 1' in lines
+    assert 'habitat_stage_seconds_bucket{stage="level_total",le="1"} 0' in lines
@@ -0,0 +1,144 @@
+import warnings
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from raster import (COG_FILE_NAME, normalize_output_formats, print_raster, print_raster_stack, rasterize_layers,
+                    reproject_raster, target_grid, update_cog)
+
+
+def burn(gdf, layer_names):
+    stack, _ = rasterize_layers(gdf, layer_names, 1, transform=from_origin(0, 4, 1, 1), out_shape=(4, 4))
+    return stack
+
+
+def test_first_feature_wins_where_features_overlap():
+    gdf = gpd.GeoDataFrame({'clay': [1.0, 2.0]}, geometry=[box(0, 0, 3, 3), box(1, 1, 4, 4)])
+    stack = burn(gdf, ['clay'])
+    assert stack[0, 3, 0] == 1  # first feature only
+    assert stack[0, 1, 2] == 1  # overlap
+    assert stack[0, 0, 3] == 2  # second feature only
+
+
+def test_nan_attribute_is_filled_from_later_features_per_band():
+    gdf = gpd.GeoDataFrame({'clay': [np.nan, 2.0], 'sand': [5.0, 6.0]}, geometry=[box(0, 0, 3, 3), box(1, 1, 4, 4)])
+    stack = burn(gdf, ['clay', 'sand'])
+    # In the overlap clay comes from the second feature, sand still from the first
+    assert stack[0, 1, 2] == 2
+    assert stack[1, 1, 2] == 5
+    # Outside the second feature there is no clay value at all
+    assert np.isnan(stack[0, 3, 0])
+    assert stack[1, 3, 0] == 5
+
+
+def test_rows_sharing_a_geometry_take_their_first_value():
+    shape = box(0, 0, 4, 4)
+    gdf = gpd.GeoDataFrame({'clay': [np.nan, 3.0, 4.0]}, geometry=[shape, shape, shape])
+    assert np.all(burn(gdf, ['clay']) == 3)
+
+
+def test_attribute_mapping_and_unmapped_values():
+    gdf = gpd.GeoDataFrame({'soil': ['Alfisols', 'Unknown order']}, geometry=[box(0, 0, 2, 4), box(2, 0, 4, 4)])
+    stack, _ = rasterize_layers(gdf, ['soil'], 1, attribute_mappings={'soil': {'Alfisols': 0.5}},
+                                transform=from_origin(0, 4, 1, 1), out_shape=(4, 4))
+    assert np.all(stack[0, :, :2] == 0.5)
+    assert np.all(np.isnan(stack[0, :, 2:]))
+
+
+def test_normalize_output_formats():
+    assert normalize_output_formats('png,cog,png') == ['cog', 'png']
+    assert normalize_output_formats(['png']) == ['png']
+    with pytest.raises(ValueError):
+        normalize_output_formats(['gif'])
+
+
+def test_merged_geometry_is_ranked_by_the_row_that_supplied_its_value():
+    # A and C share a geometry; A has no value, so C's value ranks after B
+    first, second = box(0, 0, 3, 3), box(1, 1, 4, 4)
+    gdf = gpd.GeoDataFrame({'clay': [np.nan, 5.0, 7.0]}, geometry=[first, second, first])
+    stack = burn(gdf, ['clay'])
+    assert stack[0, 1, 2] == 5
+    assert stack[0, 3, 0] == 7
+
+
+def read_png(path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(str(path)) as src:
+            return src.read(1)
+
+
+def level_grid(seed=0, shape=(60, 80)):
+    rng = np.random.default_rng(seed)
+    transform = from_origin(-124.21, 43.41, 15 / 111000, 15 / 111000)
+    return rng.uniform(0, 100, shape).astype(np.float32), transform
+
+
+def test_print_raster_writes_a_normalized_png(tmp_path):
+    raster_data, transform = level_grid()
+    raster_min, raster_max = print_raster(raster_data, transform, 'clay', str(tmp_path))
+    image = read_png(tmp_path / 'clay.png')
+    reprojected = reproject_raster(raster_data, transform, target_grid(transform, raster_data.shape))
+    assert image.shape == reprojected.shape
+    assert (raster_min, raster_max) == (np.nanmin(reprojected), np.nanmax(reprojected))
+    assert image.max() == 255
+
+
+def layer_stack(titles, seed=1):
+    stack = np.stack([level_grid(seed + band)[0] for band in range(len(titles))])
+    return stack, level_grid()[1]
+
+
+def test_print_raster_stack_matches_layer_by_layer(tmp_path):
+    titles = ['dem', 'clay', 'sand']
+    stack, transform = layer_stack(titles)
+    (tmp_path / 'stack').mkdir()
+    (tmp_path / 'single').mkdir()
+    stats = print_raster_stack(stack, transform, titles, str(tmp_path / 'stack'), output_formats=['png'])
+    for band, title in enumerate(titles):
+        assert stats[title] == print_raster(stack[band], transform, title, str(tmp_path / 'single'))
+        np.testing.assert_array_equal(read_png(tmp_path / 'stack' / '{}.png'.format(title)),
+                                      read_png(tmp_path / 'single' / '{}.png'.format(title)))
+
+
+def test_update_cog_replaces_only_the_given_bands(tmp_path):
+    titles = ['dem', 'clay', 'sand']
+    stack, transform = layer_stack(titles)
+    print_raster_stack(stack, transform, titles, str(tmp_path), output_formats=['cog'])
+    with rasterio.open(str(tmp_path / COG_FILE_NAME)) as src:
+        before = src.read()
+        assert src.descriptions == tuple(titles)
+
+    stack[1] += 1000
+    print_raster_stack(stack[[1]], transform, ['clay'], str(tmp_path), output_formats=['cog'], cog_titles=titles)
+    with rasterio.open(str(tmp_path / COG_FILE_NAME)) as src:
+        after = src.read()
+    np.testing.assert_array_equal(after[[0, 2]], before[[0, 2]])
+    # Outside the warped footprint the band stays nodata
+    np.testing.assert_array_equal(after[1], before[1] + np.float32(1000))
+
+    with pytest.raises(ValueError):
+        update_cog(str(tmp_path / COG_FILE_NAME), after[[1]], target_grid(transform, stack.shape[1:]), ['clay'],
+                   ['dem', 'clay'])
+
+
+def test_pixels_outside_the_footprint_are_cog_nodata_and_png_zero(tmp_path):
+    titles = ['dem', 'soil']
+    stack, transform = layer_stack(titles)
+    stack += 50
+    stack[1] /= 200
+    stats = print_raster_stack(stack, transform, titles, str(tmp_path), output_formats=['cog', 'png'])
+    with rasterio.open(str(tmp_path / COG_FILE_NAME)) as src:
+        cog = src.read()
+        assert np.isnan(src.nodata)
+    outside = np.isnan(cog[0])
+    # The warped footprint is a rotated rectangle, so the grid's corners lie outside it
+    assert outside[0, 0] and outside[-1, -1] and not outside.all()
+    assert stats['dem'] == (np.nanmin(cog[0]).item(), np.nanmax(cog[0]).item())
+    assert stats['dem'][0] >= 50
+    for title in titles:
+        image = read_png(tmp_path / '{}.png'.format(title))
+        assert not image[outside].any()
@@ -0,0 +1,120 @@
+import json
+import os
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+from result_cache import ResultCache, _dir_size, hash_key, source_versions
+
+BOUNDS = [-124.21, 43.39, -124.19, 43.41]
+RESOLUTION = 15 / 111000
+
+
+def bounding_box(bounds):
+    return gpd.GeoDataFrame({'geometry': [box(*bounds)]}, crs='EPSG:4326')
+
+
+def test_level_key_covers_bounds_resolution_and_output_formats(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.level_key(BOUNDS, RESOLUTION, ['cog', 'png'])
+    assert key == cache.level_key(BOUNDS, RESOLUTION, ['cog', 'png'])
+    assert key != cache.level_key(BOUNDS, RESOLUTION, ['png'])
+    assert key != cache.level_key(BOUNDS, RESOLUTION * 2, ['cog', 'png'])
+    assert key != cache.level_key([value + 0.001 for value in BOUNDS], RESOLUTION, ['cog', 'png'])
+
+
+def test_array_round_trip_and_corrupt_entry_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get_array('dem', BOUNDS, RESOLUTION) is None
+    cache.put_array('dem', BOUNDS, RESOLUTION, np.arange(6.0))
+    np.testing.assert_array_equal(cache.get_array('dem', BOUNDS, RESOLUTION), np.arange(6.0))
+
+    (entry_dir,) = [path for path in tmp_path.iterdir()]
+    (entry_dir / 'artifact.pkl').write_bytes(b'truncated')
+    assert cache.get_array('dem', BOUNDS, RESOLUTION) is None
+
+
+def test_vector_is_served_clipped_from_a_containing_entry(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    gdf = gpd.GeoDataFrame({'value': [1, 2]}, geometry=[box(-124.3, 43.3, -124.2, 43.4), box(-124.0, 43.0, -123.9, 43.1)],
+                           crs='EPSG:4326')
+    cache.put_vector('soil', bounding_box([-124.5, 43.0, -123.8, 43.5]), gdf)
+    clipped = cache.get_vector('soil', bounding_box([-124.25, 43.35, -124.15, 43.45]))
+    assert list(clipped['value']) == [1]
+    assert cache.get_vector('soil', bounding_box([-125.0, 43.0, -124.0, 43.5])) is None
+    assert cache.get_vector('water', bounding_box([-124.25, 43.35, -124.15, 43.45])) is None
+
+
+def test_missing_or_unreadable_entry_json_is_skipped(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.put_array('dem', BOUNDS, RESOLUTION, np.zeros(1))
+    (tmp_path / 'broken').mkdir()
+    (tmp_path / 'broken' / 'entry.json').write_text('{')
+    (tmp_path / 'empty').mkdir()
+    assert [entry['kind'] for _, entry, _ in cache._entries()] == ['dem']
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    def entry_dir(bounds):
+        return cache._entry_dir(hash_key('dem', bounds, RESOLUTION, source_versions()))
+
+    cache = ResultCache(str(tmp_path))
+    cache.put_array('dem', [0, 0, 1, 1], RESOLUTION, np.zeros(100))
+    # Room for three entries but not four
+    cache.max_bytes = 3 * _dir_size(entry_dir([0, 0, 1, 1])) + 10
+    for index in range(1, 3):
+        cache.put_array('dem', [index, 0, 1, 1], RESOLUTION, np.zeros(100))
+    for index in range(3):
+        # Entry mtimes order eviction; space them out so the order is unambiguous
+        os.utime(os.path.join(entry_dir([index, 0, 1, 1]), 'entry.json'), (index, index))
+
+    # Reading the oldest entry makes it the most recently used, so the next put evicts the second
+    assert cache.get_array('dem', [0, 0, 1, 1], RESOLUTION) is not None
+    cache.put_array('dem', [3, 0, 1, 1], RESOLUTION, np.zeros(100))
+    assert not os.path.exists(entry_dir([1, 0, 1, 1]))
+    for index in [0, 2, 3]:
+        assert cache.get_array('dem', [index, 0, 1, 1], RESOLUTION) is not None
+
+
+def test_put_level_copies_only_this_builds_outputs(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    level_path = tmp_path / 'level'
+    level_path.mkdir()
+    (level_path / 'metadata.json').write_text(json.dumps({'name': 'old', 'id': 1, 'centerPoint': [0, 0],
+                                                          'boundHeight': 1, 'clay': {'min': 0, 'max': 1}}))
+    (level_path / 'dem.png').write_bytes(b'png')
+    (level_path / 'layers.tif').write_bytes(b'stale')
+    cache.put_level('key', str(level_path), ['dem.png'])
+
+    target = tmp_path / 'target'
+    target.mkdir()
+    metadata = {'name': 'new', 'id': 2, 'centerPoint': [1, 1], 'boundHeight': 2}
+    cached = cache.get_level('key', str(target), metadata)
+    assert sorted(os.listdir(str(target))) == ['dem.png']
+    assert cached['name'] == 'new' and cached['clay'] == {'min': 0, 'max': 1}
+    assert cache.get_level('missing', str(target), metadata) is None
+
+
+def test_vector_lookup_uses_the_index_and_evicted_entries_leave_it(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    gdf = gpd.GeoDataFrame({'value': [1]}, geometry=[box(-124.3, 43.3, -124.2, 43.4)], crs='EPSG:4326')
+    cache.put_vector('soil', bounding_box([-124.5, 43.0, -123.8, 43.5]), gdf)
+    # Only vector entries are indexed
+    cache.put_array('dem', BOUNDS, RESOLUTION, np.zeros(1))
+    assert list(cache._vector_index().values())[0]['kind'] == 'soil'
+    assert len(cache._vector_index()) == 1
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache._vector_index() == {}
+    assert cache.get_vector('soil', bounding_box([-124.25, 43.35, -124.15, 43.45])) is None
+
+
+def test_water_mask_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get_water_mask('layer') is None
+    mask = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    cache.put_water_mask('layer', mask)
+    cached = cache.get_water_mask('layer')
+    assert cached.dtype == np.uint8
+    np.testing.assert_array_equal(cached, mask)
+    assert cache.get_water_mask('other') is None
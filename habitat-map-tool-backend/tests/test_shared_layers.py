@@ -0,0 +1,72 @@
+import os
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import Point, box
+from load_data import DataService
+from shared_layers import SharedLayer
+
+BOUNDS = [0.5, 0.5, 3.5, 3.5]
+
+
+def write_layer(path, count=5, offset=0):
+    gdf = gpd.GeoDataFrame({
+        'name': ['feature {}'.format(index) if index % 2 else None for index in range(count)],
+        'value': [index * 1.5 + offset for index in range(count)],
+        'count': list(range(count)),
+        'flag': [index % 2 == 0 for index in range(count)],
+        'when': pd.to_datetime(['2020-01-{:02d}'.format(index + 1) for index in range(count)]),
+        'zoned': pd.to_datetime(['2021-06-{:02d} 12:00'.format(index + 1) for index in range(count)], utc=True),
+    }, geometry=[Point(index, index) for index in range(count)], crs='EPSG:4326')
+    gdf.to_file(str(path), layer='features', driver='GPKG')
+
+
+def bounding_box(bounds):
+    return gpd.GeoDataFrame({'geometry': [box(*bounds)]}, crs='EPSG:4326')
+
+
+def direct_read(path, bounds):
+    return gpd.read_file(str(path), layer='features', bbox=tuple(bounds), fid_as_index=True)
+
+
+def test_round_trip_matches_a_direct_read(tmp_path):
+    path = tmp_path / 'features.gpkg'
+    write_layer(path)
+    shared = SharedLayer(str(path), 'features', str(tmp_path / 'store')).read(bounding_box(BOUNDS))
+    expected = direct_read(path, BOUNDS)
+    assert len(shared) == 3
+    pd.testing.assert_frame_equal(pd.DataFrame(shared.drop(columns='geometry')),
+                                  pd.DataFrame(expected.drop(columns='geometry')), check_index_type=False)
+    assert shared.geometry.equals(expected.geometry)
+    assert shared.crs == expected.crs
+
+
+def test_a_changed_source_is_exported_to_a_new_version(tmp_path):
+    path = tmp_path / 'features.gpkg'
+    store_dir = tmp_path / 'store'
+    write_layer(path)
+    layer = SharedLayer(str(path), 'features', str(store_dir))
+    layer.read(bounding_box(BOUNDS))
+    (first_version,) = os.listdir(str(store_dir / 'features'))
+    mapped = layer.arrays['offsets']
+
+    os.remove(str(path))
+    write_layer(path, offset=100)
+    reader = SharedLayer(str(path), 'features', str(store_dir))
+    assert list(reader.read(bounding_box(BOUNDS))['value']) == [101.5, 103, 104.5]
+    assert os.listdir(str(store_dir / 'features')) != [first_version]
+    # The first reader's mapping is untouched and it moves to the new version on its next read
+    assert len(mapped) == 6
+    assert list(layer.read(bounding_box(BOUNDS))['value']) == [101.5, 103, 104.5]
+
+
+def test_shared_data_service_matches_eager():
+    inside = bounding_box([-124.22, 43.38, -124.18, 43.42])
+    eager = DataService()
+    eager.load_base_data()
+    shared = DataService(shared=True)
+    shared.load_base_data()
+    assert sorted(shared.load_soil_data(inside)['mukey']) == sorted(eager.load_soil_data(inside)['mukey'])
+    flowlines = shared.load_flowlines(inside)
+    expected = eager.load_flowlines(inside)
+    assert sorted(flowlines['nhdplusid']) == sorted(expected['nhdplusid'])
+    assert list(flowlines.dtypes) == list(expected.dtypes)
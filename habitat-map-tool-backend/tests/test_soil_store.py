@@ -0,0 +1,73 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+from load_data import SOILDB_PATH
+from soil_store import SURFACE_DEPTH_CM, load_soil_attributes
+
+ATTRIBUTES = ['om_r', 'sandtotal_r', 'silttotal_r', 'claytotal_r', 'fragvol_r']
+
+
+def reference_attributes(db_path, depth=SURFACE_DEPTH_CM):
+    """The aggregation SOIL_ATTRIBUTES_QUERY performs, done in pandas."""
+    conn = sqlite3.connect(db_path)
+    components = pd.read_sql_query("SELECT mukey, cokey, comppct_r, taxorder, map_r, airtempa_r FROM component", conn)
+    horizons = pd.read_sql_query("SELECT chkey, cokey, hzdept_r, hzdepb_r, om_r, sandtotal_r, silttotal_r, claytotal_r "
+                                 "FROM chorizon", conn)
+    fragments = pd.read_sql_query("SELECT chkey, fragvol_r FROM chfrags", conn)
+    conn.close()
+
+    horizons = horizons.merge(fragments.groupby('chkey', as_index=False)['fragvol_r'].sum(), on='chkey', how='left')
+    horizons = horizons[(horizons['hzdept_r'] < depth) & (horizons['hzdepb_r'] > horizons['hzdept_r'])].copy()
+    horizons['weight'] = (np.minimum(horizons['hzdepb_r'], depth) - np.maximum(horizons['hzdept_r'], 0)).astype(float)
+    surface = {}
+    for cokey, group in horizons.groupby('cokey'):
+        row = {}
+        for column in ATTRIBUTES:
+            valid = group[column].notna()
+            weights = group.loc[valid, 'weight']
+            row[column] = (group.loc[valid, column] * weights).sum() / weights.sum() if valid.any() else np.nan
+        surface[cokey] = row
+    surface = pd.DataFrame.from_dict(surface, orient='index')
+
+    components = components[components['cokey'].isin(surface.index)]
+    dominant = components.sort_values(['mukey', 'comppct_r', 'cokey'], ascending=[True, False, True])
+    dominant = dominant.drop_duplicates('mukey').set_index('cokey')
+    return dominant.join(surface).reset_index().set_index('mukey').sort_index()
+
+
+def aggregated(db_path, cache_path):
+    return load_soil_attributes(str(db_path), cache_path=str(cache_path)).set_index('mukey').sort_index()
+
+
+def test_aggregation_matches_pandas_reference(tmp_path):
+    result = aggregated(SOILDB_PATH, tmp_path / 'soil_attributes.pkl')
+    expected = reference_attributes(SOILDB_PATH)
+    assert list(result.index) == list(expected.index)
+    assert list(result['cokey']) == list(expected['cokey'])
+    for column in ATTRIBUTES + ['map_r', 'airtempa_r']:
+        np.testing.assert_allclose(result[column].to_numpy(), expected[column].to_numpy(dtype=float), rtol=1e-9)
+
+
+def test_components_without_surface_horizons_are_not_dominant(tmp_path):
+    db_path = tmp_path / 'soil.gpkg'
+    conn = sqlite3.connect(str(db_path))
+    conn.executescript("""
+        CREATE TABLE component (mukey TEXT, cokey TEXT, comppct_r INTEGER, taxorder TEXT, map_r REAL, airtempa_r REAL);
+        CREATE TABLE chorizon (chkey TEXT, cokey TEXT, hzdept_r INTEGER, hzdepb_r INTEGER, om_r INTEGER,
+                               sandtotal_r INTEGER, silttotal_r INTEGER, claytotal_r INTEGER);
+        CREATE TABLE chfrags (chkey TEXT, fragvol_r INTEGER);
+        INSERT INTO component VALUES ('1', 'a', 80, 'Alfisols', 1, 1), ('1', 'b', 20, 'Entisols', 2, 2),
+                                     ('2', 'c', 60, 'Alfisols', 3, 3), ('2', 'd', 40, 'Entisols', 4, 4);
+        INSERT INTO chorizon VALUES ('h1', 'b', 0, 10, 1, 10, 20, 30), ('h2', 'b', 10, 40, 2, 11, 21, 31),
+                                    ('h3', 'c', 40, 60, 5, 5, 5, 5), ('h4', 'd', 0, 30, 3, 33, 33, 33);
+        INSERT INTO chfrags VALUES ('h1', 6), ('h1', 3);
+    """)
+    conn.close()
+
+    result = aggregated(db_path, tmp_path / 'soil_attributes.pkl')
+    # 'a' has no horizons and 'c' none in the surface layer, so the smaller components win
+    assert list(result['cokey']) == ['b', 'd']
+    # Integer attributes are weighted 10 and 20 cm over the top 30 cm, not integer-divided
+    assert result.loc['1', 'sandtotal_r'] == (10 * 10 + 11 * 20) / 30
+    assert result.loc['1', 'fragvol_r'] == 9
+    assert np.isnan(result.loc['2', 'fragvol_r'])
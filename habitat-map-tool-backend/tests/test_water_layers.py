@@ -0,0 +1,57 @@
+import numpy as np
+from water_layers import build_water_layers, build_water_layers_tiled, lowest_water_elevation
+
+
+def synthetic_grid(shape=(300, 280), seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    dem = (cols * 0.3 + rng.normal(0, 0.5, shape)).astype(np.float32)
+    water = np.zeros(shape, dtype=np.uint8)
+    water[120:126, :] = 1
+    water[:, 40:43] = 1
+    return dem, water
+
+
+def test_lowest_water_elevation_ignores_nan_water():
+    dem = np.array([[np.nan, 5.0], [3.0, 1.0]], dtype=np.float32)
+    mask = np.array([[True, True], [True, False]])
+    assert lowest_water_elevation(dem, mask) == 3.0
+    assert np.isnan(lowest_water_elevation(dem, np.array([[True, False], [False, False]])))
+    assert np.isnan(lowest_water_elevation(dem, np.zeros((2, 2), dtype=bool)))
+
+
+def test_water_over_dem_nodata_keeps_the_flood_layer_defined():
+    dem, water = synthetic_grid()
+    # The DEM is NaN past its edge; water there must not make the reference elevation NaN
+    dem[:, :20] = np.nan
+    water[:, :20] = 1
+    adjusted_dem, water_gradient, flood = build_water_layers(dem, water)
+    valid = ~np.isnan(dem)
+    assert np.isfinite(flood[valid]).all()
+    assert np.isfinite(water_gradient).all()
+    assert flood[water.view(bool)].min() == 1
+
+
+def test_no_water_gives_zero_gradients():
+    dem, _ = synthetic_grid()
+    water = np.zeros(dem.shape, dtype=np.uint8)
+    adjusted_dem, water_gradient, flood = build_water_layers(dem, water)
+    np.testing.assert_array_equal(adjusted_dem, dem)
+    assert not water_gradient.any()
+    assert not flood.any()
+
+
+def test_tiled_matches_untiled():
+    dem, water = synthetic_grid()
+    expected = build_water_layers(dem, water)
+    tiled = build_water_layers_tiled(dem, water, tile_size=64)
+    for expected_layer, tiled_layer in zip(expected, tiled):
+        np.testing.assert_array_equal(tiled_layer, expected_layer)
+
+
+def test_tiled_workers_match_untiled():
+    dem, water = synthetic_grid()
+    expected = build_water_layers(dem, water)
+    tiled = build_water_layers_tiled(dem, water, tile_size=64, workers=4)
+    for expected_layer, tiled_layer in zip(expected, tiled):
+        np.testing.assert_array_equal(tiled_layer, expected_layer)
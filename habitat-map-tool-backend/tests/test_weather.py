@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pandas as pd
+from weather import WeatherService, weather_columns
+
+BOX = [-1.0, -1.0, 1.0, 1.0]
+
+
+def write_stations(path, coords, values):
+    columns = weather_columns()
+    table = pd.DataFrame(np.asarray(values, dtype=float), columns=columns)
+    table.insert(0, 'Lat_DD', [lat for _, lat in coords])
+    table.insert(0, 'Lon_DD', [lon for lon, _ in coords])
+    table.to_csv(str(path), index=False)
+
+
+def station_values(value, count=len(weather_columns())):
+    return [value] * count
+
+
+def test_box_without_stations_is_nan_unless_idw_is_enabled(tmp_path):
+    # Distances 2 and 4 from the box centre, so the weights are 1/4 and 1/16
+    write_stations(tmp_path / 'weather.csv', [(2, 0), (0, 4)], [station_values(10), station_values(20)])
+    service = WeatherService(str(tmp_path / 'weather.csv'))
+    assert np.isnan(service.monthly_values(BOX, idw_fallback=False)).all()
+    np.testing.assert_allclose(service.monthly_values(BOX, idw_fallback=True), (10 / 4 + 20 / 16) / (1 / 4 + 1 / 16))
+
+
+def test_idw_skips_missing_readings_and_stations_inside_win(tmp_path):
+    missing = station_values(30)
+    missing[0] = np.nan
+    write_stations(tmp_path / 'weather.csv', [(2, 0), (3, 0)], [station_values(10), missing])
+    service = WeatherService(str(tmp_path / 'weather.csv'))
+    values = service.monthly_values(BOX, idw_fallback=True)
+    assert values[0] == 10
+    np.testing.assert_allclose(values[1], (10 / 4 + 30 / 9) / (1 / 4 + 1 / 9))
+
+    write_stations(tmp_path / 'inside.csv', [(0.5, 0), (2, 0)], [station_values(5), station_values(10)])
+    temp_data, precip_data = WeatherService(str(tmp_path / 'inside.csv')).get_weather_data(BOX, idw_fallback=True)
+    assert temp_data[0] == {'monthIdx': 0, 'mean': 5, 'low': 5, 'high': 5}
+    assert len(precip_data) == 12
+
+
+def test_npz_cache_is_reused_until_the_csv_changes(tmp_path):
+    path = tmp_path / 'weather.csv'
+    write_stations(path, [(0, 0)], [station_values(1)])
+    WeatherService(str(path))
+    assert (tmp_path / 'weather.npz').exists()
+    assert [item.name for item in tmp_path.iterdir() if item.suffix == '.tmp'] == []
+    assert WeatherService(str(path)).values[0, 0] == 1
+
+    write_stations(path, [(0, 0)], [station_values(2)])
+    stat = path.stat()
+    os.utime(str(path), (stat.st_atime, stat.st_mtime + 10))
+    assert WeatherService(str(path)).values[0, 0] == 2
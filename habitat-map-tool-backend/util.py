@@ -1,10 +1,36 @@
+import os
+import threading
 import time
+from contextlib import contextmanager
 
-start = time.time()
+# Each thread keeps its own lap start so concurrent builds don't skew each other's timings
+_local = threading.local()
 
 def get_elapsed_time():
-    global start
+    start = getattr(_local, 'start', None) or time.time()
     elapsed = time.time() - start
-    start = time.time()
+    _local.start = time.time()
     return " - "+str(round(elapsed,2)) + "s"
 
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Write path through a temporary file that is renamed over it when the block
+    succeeds, so readers in other threads or processes see the old file or the
+    whole new one. Yields the open file, or the temporary path when mode is None
+    for writers that open files by name.
+    """
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        if mode is None:
+            yield temp_path
+        else:
+            with open(temp_path, mode) as f:
+                yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
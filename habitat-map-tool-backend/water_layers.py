@@ -0,0 +1,195 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import convolve, distance_transform_edt
+from scratch import ScratchArena
+from util import get_elapsed_time
+
+BUFFER_DISTANCE = 3  # Buffer distance in meters
+FLOOD_BUFFER_DISTANCE = 5
+PIXEL_SIZE = 1  # Assuming each pixel represents 1 meter (adjust if needed)
+MAX_ELEVATION_DIFF = 50
+
+# Grids with more pixels than this are post-processed in tiles
+TILED_PIXEL_THRESHOLD = int(os.environ.get('HABITAT_TILED_PIXELS', 4096 * 4096))
+TILE_SIZE = 1024
+# Widest halo a tile grows to; see build_water_layers_tiled
+MAX_TILE_HALO = int(os.environ.get('HABITAT_MAX_TILE_HALO', TILE_SIZE))
+# Threads that process tiles; the convolution, distance transform and numpy passes release
+# the GIL. Levels already build in parallel across JobQueue workers, so this defaults to one.
+TILE_WORKERS = max(1, int(os.environ.get('HABITAT_TILE_WORKERS', 1)))
+
+# Distance used for tiles with no water at all: effectively infinite, but finite so 0 * distance stays 0
+WATER_FREE_DISTANCE = 1e30
+
+
+def adjust_height(water_count, base_depth=0, max_depth=20, max_count=9, out=None):
+    """Carve depth from the squared share of water neighbours; out may be a float32 buffer."""
+    scaling_factor = np.multiply(water_count, water_count, out=out, dtype=np.float32)
+    scaling_factor *= (max_depth - base_depth) / (max_count * max_count)
+    scaling_factor += base_depth
+    return np.clip(scaling_factor, 0, max_depth, out=scaling_factor)
+
+def water_distance(water_mask, arena):
+    distance = arena.get('distance', water_mask.shape, np.float64)
+    if not water_mask.any():
+        distance.fill(WATER_FREE_DISTANCE)
+        return distance
+    distance_transform_edt(~water_mask, distances=distance)
+    return distance
+
+def buffer_raster_with_gradient(water_mask, distance, buffer_distance, pixel_size, out):
+    buffer_size = int(buffer_distance / pixel_size)
+    np.divide(distance, buffer_size, out=out, casting='same_kind')
+    np.subtract(1, out, out=out)
+    np.clip(out, 0, 1, out=out)
+    np.copyto(out, 1, where=water_mask)
+    return out
+
+def lowest_water_elevation(dem_raster, water_mask):
+    """
+    Reference elevation of the flood gradient: the lowest water pixel with an elevation.
+    Water over DEM nodata (NaN past the DEM edge) is ignored; NaN when no water pixel has one.
+    """
+    water_elevations = dem_raster[water_mask]
+    if not np.isfinite(water_elevations).any():
+        return np.nan
+    return np.nanmin(water_elevations)
+
+def buffer_flood_zone_raster(water_mask, dem_raster, distance, buffer_distance, pixel_size, max_elevation_diff,
+                             water_min_elevation, out):
+    buffer_size = int(buffer_distance / pixel_size)
+
+    # Compute the elevation gradient; without a reference elevation it falls back to distance alone
+    if np.isnan(water_min_elevation):
+        np.multiply(dem_raster, 0, out=out)
+        out += 1
+    else:
+        np.subtract(dem_raster, water_min_elevation, out=out)
+        np.abs(out, out=out)
+        out /= max_elevation_diff
+        np.clip(out, 0, 1, out=out)
+
+    # Combine distance and elevation to create a gradient
+    np.multiply(out, distance, out=out, casting='same_kind')
+    out /= buffer_size
+    np.subtract(1, out, out=out)
+    np.clip(out, 0, 1, out=out)
+    np.copyto(out, 1, where=water_mask)
+    return out
+
+def build_water_layers(dem_raster, water_mask, water_min_elevation=None, out=None, arena=None):
+    """
+    Derive the adjusted DEM, water gradient and flood layers from a 0/1 uint8 water mask.
+
+    Results go into out, a tuple of three float32 arrays (adjusted_dem, water, flood),
+    which can be slices of the level's layer stack. One distance transform is shared
+    by both gradients and all temporaries come from the scratch arena.
+    """
+    if out is None:
+        out = tuple(np.empty(dem_raster.shape, dtype=np.float32) for _ in range(3))
+    arena = arena or ScratchArena()
+    adjusted_dem, water_gradient, flood_raster = out
+    mask = water_mask.view(bool)
+    if water_min_elevation is None:
+        water_min_elevation = lowest_water_elevation(dem_raster, mask)
+
+    # Convolve the water layer with the kernel to count surrounding water pixels
+    water_count = arena.get('water_count', dem_raster.shape, np.uint8)
+    convolve(water_mask, np.ones((3,3), dtype=np.uint8), output=water_count, mode='constant', cval=0)
+
+    # Apply the adjustment
+    depth_adjustment = adjust_height(water_count, out=arena.get('depth', dem_raster.shape, np.float32))
+    np.copyto(adjusted_dem, dem_raster)
+    np.subtract(adjusted_dem, depth_adjustment, out=adjusted_dem, where=mask)
+
+    distance = water_distance(mask, arena)
+    buffer_flood_zone_raster(mask, dem_raster, distance, FLOOD_BUFFER_DISTANCE, PIXEL_SIZE, MAX_ELEVATION_DIFF,
+                             water_min_elevation, flood_raster)
+    buffer_raster_with_gradient(mask, distance, BUFFER_DISTANCE, PIXEL_SIZE, water_gradient)
+    return out
+
+def tile_halo():
+    """Overlap that keeps the convolution and the water gradient exact, and the flood gradient exact near water."""
+    return max(1, int(BUFFER_DISTANCE / PIXEL_SIZE), int(FLOOD_BUFFER_DISTANCE / PIXEL_SIZE))
+
+def required_halo(dem_core, distance_core, halo, water_min_elevation):
+    """
+    Halo a tile needs for its flood gradient to be exact.
+
+    A core pixel whose nearest water in the window is further than halo may have
+    closer water outside it. Its flood value is only non-zero while
+    elevation_factor * distance < FLOOD_BUFFER_DISTANCE, so the halo must reach
+    FLOOD_BUFFER_DISTANCE / elevation_factor for the flattest such pixel.
+    """
+    flood_buffer = int(FLOOD_BUFFER_DISTANCE / PIXEL_SIZE)
+    elevation_factor = np.clip(np.abs(dem_core - water_min_elevation) / MAX_ELEVATION_DIFF, 0, 1)
+    uncertain = (distance_core > halo) & (elevation_factor > 0) & (elevation_factor * halo < flood_buffer)
+    if not uncertain.any():
+        return halo
+    return math.ceil(flood_buffer / elevation_factor[uncertain].min()) + 1
+
+def build_water_tile(dem_raster, water_mask, out, row, col, tile_size, max_halo, water_min_elevation, arena):
+    """Write one tile's core into out, widening its halo as needed; returns how many times it was widened."""
+    height, width = dem_raster.shape
+    rows = min(tile_size, height - row)
+    cols = min(tile_size, width - col)
+    halo = tile_halo()
+    widened = 0
+    while True:
+        row0, row1 = max(0, row - halo), min(height, row + rows + halo)
+        col0, col1 = max(0, col - halo), min(width, col + cols + halo)
+        window = (slice(row0, row1), slice(col0, col1))
+        tile_out = tuple(arena.get(name, (row1 - row0, col1 - col0), np.float32)
+                         for name in ('tile_adjusted_dem', 'tile_water', 'tile_flood'))
+        tiles = build_water_layers(dem_raster[window], water_mask[window], water_min_elevation,
+                                   out=tile_out, arena=arena)
+        core = (slice(row - row0, row - row0 + rows), slice(col - col0, col - col0 + cols))
+        whole_grid = (row0, col0, row1, col1) == (0, 0, height, width)
+        needed = min(required_halo(dem_raster[row:row + rows, col:col + cols], arena.buffers['distance'][core],
+                                   halo, water_min_elevation), max_halo)
+        if needed <= halo or whole_grid:
+            break
+        halo = needed
+        widened += 1
+    for layer, tile in zip(out, tiles):
+        layer[row:row + rows, col:col + cols] = tile[core]
+    return widened
+
+def build_water_layers_tiled(dem_raster, water_mask, out=None, tile_size=TILE_SIZE, max_halo=MAX_TILE_HALO,
+                             workers=TILE_WORKERS):
+    """
+    Tiled equivalent of build_water_layers for large grids.
+
+    Tiles are spread over workers threads, each with its own scratch arena, so
+    scratch memory is bounded by workers times the tile and its halo. Results are
+    written into out, normally slices of the level's layer stack; tiles write
+    disjoint cores. Each tile starts with tile_halo() and is redone with the wider
+    halo from required_halo() when a pixel's flood value could depend on water
+    outside its window. Pixels that would need more than max_halo (barely above the
+    lowest water and far from any) use the water within max_halo.
+    """
+    height, width = dem_raster.shape
+    if out is None:
+        out = tuple(np.empty(dem_raster.shape, dtype=np.float32) for _ in range(3))
+    # The flood gradient is relative to the lowest water in the whole level, not per tile
+    water_min_elevation = lowest_water_elevation(dem_raster, water_mask.view(bool))
+    origins = [(row, col) for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+    local = threading.local()
+
+    def build_tile(origin):
+        if not hasattr(local, 'arena'):
+            local.arena = ScratchArena()
+        return build_water_tile(dem_raster, water_mask, out, *origin, tile_size, max_halo, water_min_elevation,
+                                local.arena)
+
+    if workers > 1 and len(origins) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(origins))) as executor:
+            widened = sum(executor.map(build_tile, origins))
+    else:
+        widened = sum(map(build_tile, origins))
+    print("Processed water layers in {} tiles ({} widened, {} workers) {}".format(
+        len(origins), widened, min(workers, len(origins)), get_elapsed_time()))
+    return out
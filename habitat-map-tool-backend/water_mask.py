@@ -0,0 +1,49 @@
+import os
+import numpy as np
+from rasterio.features import rasterize
+from scipy.ndimage import binary_dilation
+from util import get_elapsed_time
+
+# Widen flowline strokes with mean annual flow (qe) instead of drawing every line one pixel wide
+FLOW_SCALED_STROKES = os.environ.get('HABITAT_FLOW_SCALED_STROKES') == '1'
+FLOW_PER_STROKE_PIXEL = 3000
+MAX_STROKE_PIXELS = 7
+
+
+def stroke_widths(qe, flow_scaled=FLOW_SCALED_STROKES):
+    """Stroke width in pixels for each flowline, always odd so lines stay centred."""
+    if not flow_scaled:
+        return np.ones(len(qe), dtype=int)
+    extra = np.nan_to_num(np.asarray(qe, dtype=float) / FLOW_PER_STROKE_PIXEL, nan=0.0)
+    widths = 1 + 2 * np.floor(extra).astype(int)
+    return np.clip(widths, 1, MAX_STROKE_PIXELS)
+
+def _disk(radius):
+    offsets = np.arange(-radius, radius + 1)
+    return offsets[:, None] ** 2 + offsets[None, :] ** 2 <= radius * radius
+
+def rasterize_water(flowlines_gdf, waterbodies_gdf, transform, out_shape, flow_scaled=FLOW_SCALED_STROKES):
+    """
+    Burn waterbodies and flowlines into a uint8 0/1 mask on the given grid.
+
+    Waterbodies are burned in one bulk call. Flowlines are rasterized directly as
+    lines (all_touched, so one pixel wide), one call per stroke width; wider
+    strokes are then dilated with a disk. Pixels off water are 0, so water
+    neighbour counts are defined everywhere.
+    """
+    water_mask = np.zeros(out_shape, dtype=np.uint8)
+    if len(waterbodies_gdf):
+        rasterize(((geometry, 1) for geometry in waterbodies_gdf.geometry), out=water_mask,
+                  transform=transform, all_touched=True)
+
+    widths = stroke_widths(flowlines_gdf['qe'], flow_scaled) if len(flowlines_gdf) else np.array([], dtype=int)
+    for width in np.unique(widths):
+        lines = flowlines_gdf.geometry[widths == width]
+        if width == 1:
+            rasterize(((geometry, 1) for geometry in lines), out=water_mask, transform=transform, all_touched=True)
+            continue
+        strokes = rasterize(((geometry, 1) for geometry in lines), out_shape=out_shape, transform=transform,
+                            all_touched=True, dtype='uint8')
+        water_mask |= binary_dilation(strokes, structure=_disk(width // 2)).astype(np.uint8)
+    print("Rasterized {} flowlines and {} waterbodies {}".format(len(flowlines_gdf), len(waterbodies_gdf), get_elapsed_time()))
+    return water_mask
@@ -1,34 +1,122 @@
+import os
+import warnings
+import zipfile
+import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
+from util import atomic_write, get_elapsed_time
 
+WEATHER_PATH = '../data/WeatherDataMonthly.csv'
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+# Per month: (metadata key, CSV column template) for temperature and precipitation
+TEMP_FIELDS = [('mean', 'Mean_{}_Temp'), ('low', 'Mean_Low_{}_Temp'), ('high', 'Mean_High_{}_Temp')]
+PRECIP_FIELDS = [('mean', 'Mean_{}_Precip'), ('min', 'Min_{}_Precip'), ('max', 'Max_{}_Precip')]
+
+# Boxes without a station fall back to inverse-distance weighting of the nearest stations
+IDW_FALLBACK = os.environ.get('HABITAT_WEATHER_IDW') == '1'
+IDW_NEIGHBOURS = 4
+IDW_POWER = 2
+
+
+def weather_columns():
+    columns = []
+    for month in MONTHS:
+        columns += [template.format(month) for _, template in TEMP_FIELDS]
+        columns += [template.format(month) for _, template in PRECIP_FIELDS]
+    return columns
+
+
+class WeatherService:
+    """
+    Station table held as NumPy arrays with a KD-tree over station coordinates.
+
+    The CSV is parsed once and cached as an .npz next to it, rebuilt whenever the
+    CSV's mtime changes.
+    """
+
+    def __init__(self, path=WEATHER_PATH):
+        self.path = path
+        self.columns = weather_columns()
+        self.coords, self.values = self._load()
+        self.tree = cKDTree(self.coords)
+        print("Weather stations indexed: {} {}".format(len(self.coords), get_elapsed_time()))
+
+    def _load(self):
+        cache_path = os.path.splitext(self.path)[0] + '.npz'
+        csv_mtime = os.path.getmtime(self.path)
+        try:
+            with np.load(cache_path) as cached:
+                if cached['csv_mtime'] == csv_mtime:
+                    return cached['coords'], cached['values']
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing, or left unreadable by an older writer; rebuilt below
+            pass
+        weather_data = pd.read_csv(self.path)
+        coords = weather_data[['Lon_DD', 'Lat_DD']].to_numpy(dtype=np.float64)
+        values = weather_data[self.columns].to_numpy(dtype=np.float64)
+        # Written atomically so other workers never load a partial cache
+        try:
+            with atomic_write(cache_path, 'wb') as f:
+                np.savez(f, coords=coords, values=values, csv_mtime=csv_mtime)
+        except OSError as e:
+            print("Could not write weather cache: {}".format(e))
+        return coords, values
+
+    def stations_in_box(self, bounding_box):
+        minx, miny, maxx, maxy = bounding_box
+        center = [(minx + maxx) / 2, (miny + maxy) / 2]
+        radius = max(maxx - minx, maxy - miny) / 2
+        candidates = np.asarray(self.tree.query_ball_point(center, radius, p=np.inf), dtype=int)
+        coords = self.coords[candidates]
+        inside = ((coords[:, 0] >= minx) & (coords[:, 0] <= maxx) &
+                  (coords[:, 1] >= miny) & (coords[:, 1] <= maxy))
+        return candidates[inside]
+
+    def monthly_values(self, bounding_box, idw_fallback=IDW_FALLBACK):
+        """Average every weather column over the stations in the box, in one reduction."""
+        stations = self.stations_in_box(bounding_box)
+        if len(stations):
+            with warnings.catch_warnings():
+                # Columns with no readings average to NaN, as pandas' mean() did
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return np.nanmean(self.values[stations], axis=0)
+        if not idw_fallback or len(self.coords) == 0:
+            return np.full(len(self.columns), np.nan)
+
+        minx, miny, maxx, maxy = bounding_box
+        # With fewer stations than neighbours asked for, the tree pads with out-of-range indices
+        k = min(IDW_NEIGHBOURS, len(self.coords))
+        distances, neighbours = self.tree.query([(minx + maxx) / 2, (miny + maxy) / 2], k=k)
+        distances, neighbours = np.atleast_1d(distances), np.atleast_1d(neighbours)
+        weights = 1 / np.maximum(distances, 1e-9) ** IDW_POWER
+        values = self.values[neighbours]
+        valid = ~np.isnan(values)
+        weighted = np.where(valid, values, 0).T @ weights
+        total_weight = valid.T.astype(np.float64) @ weights
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return weighted / total_weight
+
+    def get_weather_data(self, bounding_box, idw_fallback=IDW_FALLBACK):
+        values = self.monthly_values(bounding_box, idw_fallback).reshape(len(MONTHS), -1)
+        temp_data = []
+        precip_data = []
+        for i in range(0,12):
+            month = {'monthIdx': i}
+            month.update({key: values[i, idx].item() for idx, (key, _) in enumerate(TEMP_FIELDS)})
+            temp_data.append(month)
+            month = {'monthIdx': i}
+            month.update({key: values[i, len(TEMP_FIELDS) + idx].item() for idx, (key, _) in enumerate(PRECIP_FIELDS)})
+            precip_data.append(month)
+        return temp_data, precip_data
+
+
+_weather_service = None
+
+def get_weather_service():
+    global _weather_service
+    if _weather_service is None:
+        _weather_service = WeatherService()
+    return _weather_service
 
 def get_weather_data(bounding_box):
-    weather_data = pd.read_csv('../data/WeatherDataMonthly.csv')
-    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-
-    filtered_data = weather_data[
-        (weather_data['Lon_DD'] >= bounding_box[0]) & 
-        (weather_data['Lon_DD'] <= bounding_box[2]) & 
-        (weather_data['Lat_DD'] >= bounding_box[1]) & 
-        (weather_data['Lat_DD'] <= bounding_box[3])
-    ]
-
-    temp_data = []
-    precip_data = []
-    # each month is
-    for i in range(0,12):
-        month = {
-            'monthIdx': i,
-            'mean': filtered_data['Mean_' + months[i] + '_Temp'].mean(),
-            'low': filtered_data['Mean_Low_' + months[i] + '_Temp'].mean(),
-            'high': filtered_data['Mean_High_' + months[i] + '_Temp'].mean()
-        }
-        temp_data.append(month)
-        month = {
-            'monthIdx': i,
-            'mean': filtered_data['Mean_' + months[i] + '_Precip'].mean(),
-            'min': filtered_data['Min_' + months[i] + '_Precip'].mean(),
-            'max': filtered_data['Max_' + months[i] + '_Precip'].mean()
-        }
-        precip_data.append(month)
-
-    return temp_data, precip_data
\ No newline at end of file
+    return get_weather_service().get_weather_data(bounding_box)